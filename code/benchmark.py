@@ -0,0 +1,212 @@
+# Time each stage of the telemetry pipeline over a recorded dataset
+# Example: $ python benchmark.py ../test_dataset/robot_log.csv --output bench.json
+import argparse
+import contextlib
+import json
+import os
+import platform
+import subprocess
+import time
+import tracemalloc
+from datetime import datetime
+
+import cv2
+import numpy as np
+
+from drive_rover import RoverState
+from perception import perception_step
+from decision import decision_step
+from supporting_functions import update_rover, create_output_images, SimClock
+from replay import read_robot_log, make_telemetry, frame_timestamp
+
+# Stages in the order telemetry() runs them
+STAGES = ['update_rover', 'perception_step', 'decision_step', 'create_output_images']
+
+
+def run_stages(Rover, data, timer):
+    """Run one telemetry frame through every stage.
+    timer is called as timer(stage_index, function, *args)"""
+    # Decisions follow the recorded time, not the benchmark's
+    Rover.clock.set(data['recorded_time'])
+    Rover, image = timer(0, update_rover, Rover, data)
+    Rover = timer(1, perception_step, Rover)
+    Rover = timer(2, decision_step, Rover)
+    timer(3, create_output_images, Rover)
+    return Rover
+
+
+def time_frames(messages, repeat):
+    """Time every stage of every frame.
+    Output: (frames, stages) array of latencies in seconds"""
+    latencies = np.zeros((len(messages) * repeat, len(STAGES)))
+    frame = 0
+
+    def timer(stage, function, *args):
+        start = time.perf_counter()
+        result = function(*args)
+        latencies[frame, stage] = time.perf_counter() - start
+        return result
+
+    for _ in range(repeat):
+        Rover = RoverState(clock=SimClock())
+        for data in messages:
+            Rover = run_stages(Rover, data, timer)
+            frame += 1
+    return latencies
+
+
+def trace_allocations(messages):
+    """Trace the memory each stage allocates.
+    Tracing is slow, so this runs apart from the timing pass.
+    Output: (frames, stages) arrays of allocated blocks and peak bytes"""
+    blocks = np.zeros((len(messages), len(STAGES)))
+    peak_bytes = np.zeros((len(messages), len(STAGES)))
+    frame = 0
+
+    def timer(stage, function, *args):
+        before = tracemalloc.take_snapshot()
+        current, _ = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        result = function(*args)
+        _, peak = tracemalloc.get_traced_memory()
+        after = tracemalloc.take_snapshot()
+        # New blocks still alive after the stage, plus the transient peak
+        blocks[frame, stage] = sum(max(stat.count_diff, 0)
+                                   for stat in after.compare_to(before, 'lineno'))
+        peak_bytes[frame, stage] = peak - current
+        return result
+
+    Rover = RoverState(clock=SimClock())
+    tracemalloc.start()
+    try:
+        for data in messages:
+            Rover = run_stages(Rover, data, timer)
+            frame += 1
+    finally:
+        tracemalloc.stop()
+    return blocks, peak_bytes
+
+
+def summarize(latencies, blocks=None, peak_bytes=None):
+    """Summarize per-stage latency percentiles and throughput"""
+    summary = {}
+    columns = list(enumerate(STAGES)) + [(None, 'total')]
+    for stage, name in columns:
+        if stage is None:
+            values = latencies.sum(axis=1)
+        else:
+            values = latencies[:, stage]
+        result = {
+            'p50_ms': 1000 * np.percentile(values, 50),
+            'p95_ms': 1000 * np.percentile(values, 95),
+            'p99_ms': 1000 * np.percentile(values, 99),
+            'mean_ms': 1000 * np.mean(values),
+            'fps': len(values) / np.sum(values),
+        }
+        if blocks is not None:
+            stage_blocks = blocks.sum(axis=1) if stage is None else blocks[:, stage]
+            stage_peak = peak_bytes.max(axis=1) if stage is None else peak_bytes[:, stage]
+            result['alloc_blocks_per_frame'] = np.mean(stage_blocks)
+            result['peak_alloc_kib_per_frame'] = np.mean(stage_peak) / 1024
+        summary[name] = {key: round(float(value), 4) for key, value in result.items()}
+    return summary
+
+
+def git_revision():
+    """Current commit of the repository, if any"""
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_summary(summary, baseline=None):
+    """Print the summary table, with the p50 change against a baseline run"""
+    header = '{:<22}{:>9}{:>9}{:>9}{:>9}{:>12}'.format(
+        'stage', 'p50 ms', 'p95 ms', 'p99 ms', 'fps', 'peak KiB')
+    if baseline is not None:
+        header += '{:>10}'.format('p50 diff')
+    print(header)
+    for name, result in summary.items():
+        line = '{:<22}{:>9.2f}{:>9.2f}{:>9.2f}{:>9.1f}{:>12}'.format(
+            name, result['p50_ms'], result['p95_ms'], result['p99_ms'], result['fps'],
+            '{:.1f}'.format(result['peak_alloc_kib_per_frame'])
+            if 'peak_alloc_kib_per_frame' in result else '-')
+        if baseline is not None and name in baseline['stages']:
+            old = baseline['stages'][name]['p50_ms']
+            line += '{:>9.1f}%'.format(100 * (result['p50_ms'] - old) / old if old else 0)
+        print(line)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Telemetry pipeline benchmark')
+    parser.add_argument(
+        'csv_path',
+        type=str,
+        nargs='?',
+        default='../test_dataset/robot_log.csv',
+        help='Path to the robot_log.csv of the recording.'
+    )
+    parser.add_argument(
+        '--repeat',
+        type=int,
+        default=3,
+        help='Number of timed passes over the recording.'
+    )
+    parser.add_argument(
+        '--no-alloc',
+        action='store_true',
+        help='Skip the allocation tracing pass.'
+    )
+    parser.add_argument(
+        '--output',
+        type=str,
+        default='benchmark.json',
+        help='Path of the json results file.'
+    )
+    parser.add_argument(
+        '--compare',
+        type=str,
+        default='',
+        help='Path of an earlier json results file to compare with.'
+    )
+    args = parser.parse_args()
+
+    frames = read_robot_log(args.csv_path)
+    # Messages are built up front so file reads are not timed
+    messages = [make_telemetry(frame) for frame in frames]
+    for frame, data in zip(frames, messages):
+        data['recorded_time'] = frame_timestamp(frame['path'])
+
+    # decision_step and update_rover print every frame, keep that off the terminal
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        # One untimed pass to warm up caches and lazy imports
+        time_frames(messages[:10], 1)
+        latencies = time_frames(messages, args.repeat)
+        if args.no_alloc:
+            blocks, peak_bytes = None, None
+        else:
+            blocks, peak_bytes = trace_allocations(messages)
+
+    results = {
+        'revision': git_revision(),
+        'date': datetime.utcnow().isoformat(),
+        'dataset': args.csv_path,
+        'frames': len(messages),
+        'repeat': args.repeat,
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'opencv': cv2.__version__,
+        'machine': platform.machine(),
+        'stages': summarize(latencies, blocks, peak_bytes),
+    }
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+
+    baseline = None
+    if args.compare != '':
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print_summary(results['stages'], baseline)
+    print("Saved results to {}".format(args.output))
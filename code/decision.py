@@ -1,5 +1,6 @@
 import numpy as np
-import time
+from planner import GridPlanner, Explorer
+from worldmap import clean_obstacles
 # This is where you can build a decision tree for determining throttle, brake and steer
 # commands based on the output of the perception_step() function
 
@@ -18,19 +19,49 @@ def calculate_angle_error(x_1, x_2, yaw):
         angle_rad = angle_rad + 2 * np.pi
     # transfer radians to degree
     angle_degree = angle_rad * 180 / np.pi
-    angle_error = angle_degree - yaw
+    # Wrap to [-180, 180) so the rover turns the short way round
+    angle_error = (angle_degree - yaw + 180) % 360 - 180
     return angle_error
 
 
-def left_side_mode(obstacle_img, nav_angles):
+def home_target(Rover):
+    '''Next waypoint of the planned path to the starting point,
+    or the starting point itself while there is no planned path.'''
+    if Rover.planner is None:
+        Rover.planner = GridPlanner(Rover.worldmap, Rover.start_point)
+    waypoints = Rover.planner.plan(Rover.pos)
+    if not waypoints:
+        return Rover.start_point
+    # Aim a few cells ahead so the rover does not zigzag from cell to cell
+    return waypoints[min(Rover.waypoint_lookahead, len(waypoints)) - 1]
+
+
+def explore_mode(Rover):
+    '''Steer toward the frontier cell with the lowest travel cost,
+    follow the left side when no frontier is left'''
+    if Rover.explorer is None:
+        Rover.explorer = Explorer(Rover.worldmap)
+    waypoints = Rover.explorer.waypoints(Rover.pos, Rover.clock.time())
+    if waypoints is None:
+        return left_side_mode(Rover.features)
+    target = waypoints[min(Rover.waypoint_lookahead, len(waypoints)) - 1]
+    Rover.angle_error = calculate_angle_error(target, Rover.pos, Rover.yaw)
+    # Keep the steer within the 30% and 70% nav angles to avoid obstacles
+    nav_angle_low = np.maximum(Rover.features.nav_angle_quantile(30), -15)
+    nav_angle_upper = np.minimum(Rover.features.nav_angle_quantile(70), 15)
+    return np.clip(Rover.angle_error, nav_angle_low, nav_angle_upper)
+
+
+def left_side_mode(features):
     '''Move along left side'''
-    pix_num_small_l = np.count_nonzero(obstacle_img[145:155, 155:162])
-    pix_num_middle_l = np.count_nonzero(obstacle_img[135:155, 140:160])
-    pix_num_large_l = np.count_nonzero(obstacle_img[130:155, 130:160])
+    # Obstacle pixels in windows of the vision image
+    pix_num_small_l = features.obstacle_count(145, 155, 155, 162)
+    pix_num_middle_l = features.obstacle_count(135, 155, 140, 160)
+    pix_num_large_l = features.obstacle_count(130, 155, 130, 160)
 
-    pix_num_small_r = np.count_nonzero(obstacle_img[140:155, 160:170])
-    pix_num_middle_r = np.count_nonzero(obstacle_img[130:155, 160:180])
-    pix_num_large_r = np.count_nonzero(obstacle_img[130:155, 160:180])
+    pix_num_small_r = features.obstacle_count(140, 155, 160, 170)
+    pix_num_middle_r = features.obstacle_count(130, 155, 160, 180)
+    pix_num_large_r = features.obstacle_count(130, 155, 160, 180)
 
     # pix_num_front = np.count_nonzero(obstacle_img[145:155, 155:165])
     # To Do: If there are obstacles in front of rover, avoid it.
@@ -49,17 +80,17 @@ def left_side_mode(obstacle_img, nav_angles):
         elif pix_num_large_r < 10:
             steer = -15
         else:
-            nav_angle_q75 = np.percentile(
-                np.array(nav_angles * 180 / np.pi), 75)
+            nav_angle_q75 = features.nav_angle_quantile(75)
             steer = np.clip(nav_angle_q75, -15, 15)
     return steer
 
 
 def return_start_point(Rover):
     '''Return to the starting pint when the rover complete some special tasks'''
-    # Calculate angle and distance from current point to start point.
+    # Calculate angle from current point to the next waypoint home.
+    target = home_target(Rover)
     Rover.angle_error = calculate_angle_error(
-        Rover.start_point, Rover.pos, Rover.yaw)
+        target, Rover.pos, Rover.yaw)
 
     if np.absolute(Rover.angle_error) > 0.5 and (not Rover.turn_to_start):
         print("Turning tarward o home point!")
@@ -79,7 +110,7 @@ def return_start_point(Rover):
                 Rover.steer = np.clip(Rover.angle_error, -15, 15)
                 # Update avaliable condition
                 Rover.angle_error = calculate_angle_error(
-                    Rover.start_point, Rover.pos, Rover.yaw)
+                    target, Rover.pos, Rover.yaw)
 
             else:
                 Rover.steer = 0
@@ -87,21 +118,19 @@ def return_start_point(Rover):
 
     # If angle error is smaller, execute back home movement
     else:
-        if len(Rover.nav_angles) >= Rover.stop_forward:
+        if Rover.features.nav_count >= Rover.stop_forward:
             # Move toward start point with obstacle avoidance
             # Using 30% and 70% larger nav_angle to be steer boundary,
             # Rover steer angle is angle error between yaw and angle to home point
-            nav_angle_q70 = np.percentile(
-                np.array(Rover.nav_angles * 180 / np.pi), 70)
-            nav_angle_q30 = np.percentile(
-                np.array(Rover.nav_angles * 180 / np.pi), 30)
+            nav_angle_q70 = Rover.features.nav_angle_quantile(70)
+            nav_angle_q30 = Rover.features.nav_angle_quantile(30)
             nav_angle_low = np.maximum(nav_angle_q30, -15)
             nav_angle_upper = np.minimum(nav_angle_q70, 15)
 
             Rover.steer = np.clip(
                 Rover.angle_error, nav_angle_low, nav_angle_upper)
             Rover.angle_error = calculate_angle_error(
-                Rover.start_point, Rover.pos, Rover.yaw)
+                target, Rover.pos, Rover.yaw)
 
             Rover.brake = 0
             # Use a larger throttle to back home
@@ -113,7 +142,7 @@ def return_start_point(Rover):
             print("Angle error: ", Rover.angle_error)
             print("Complete task, backing home!")
 
-        elif len(Rover.nav_angles) < Rover.stop_forward:
+        elif Rover.features.nav_count < Rover.stop_forward:
             # Set mode to "stop" and hit the brakes!
             Rover.throttle = 0
             # Set brake to stored brake value
@@ -126,15 +155,14 @@ def return_start_point(Rover):
 
 def pickup_mode(Rover):
     '''Pick up samples'''
-    if len(Rover.rock_angles) > 0:
+    if Rover.features.rock_count > 0:
         if Rover.near_sample and not Rover.picking_up:
             Rover.brake = Rover.brake_set
             Rover.throttle = 0
             Rover.mode = 'stop'
             Rover.send_pickup = True
         else:
-            Rover.steer = np.clip(
-                np.mean(Rover.rock_angles * 180 / np.pi), -15, 15)
+            Rover.steer = np.clip(Rover.features.rock_angle_mean, -15, 15)
             if Rover.vel > (Rover.max_vel / 2):
                 Rover.brake = 1
                 Rover.throttle = 0
@@ -146,7 +174,7 @@ def pickup_mode(Rover):
                 Rover.throttle = 1
 
     else:
-        if len(Rover.nav_angles) < Rover.stop_forward:
+        if Rover.features.nav_count < Rover.stop_forward:
             Rover.throttle = -1
         else:
             Rover.mode = 'forward'
@@ -157,7 +185,7 @@ def stuck_mode(Rover):
     """try to solve stuck conditions"""
     Rover.throttle = Rover.throttle_set * 2
     # Set a stuck time counting
-    time_counting = time.time() - Rover.time_start
+    time_counting = Rover.clock.time() - Rover.time_start
     print('Stucking time counting: ', time_counting)
     print('Rover mode: ', Rover.mode)
     # If rover stuck in low speed in forward mode.
@@ -193,7 +221,7 @@ def stuck_mode(Rover):
         Rover.steer = 10
     elif time_counting > 17:
         # Reset stuck time counting
-        Rover.time_start = time.time()
+        Rover.time_start = Rover.clock.time()
         time_counting = 0
         Rover.throttle = 0
     return Rover
@@ -201,9 +229,8 @@ def stuck_mode(Rover):
 
 def stop_mode(Rover):
     '''Stop and turn the wheel when there is no path forward'''
-    if len(Rover.rock_angles) > 0:
-        Rover.steer = np.clip(
-            np.mean(Rover.rock_angles * 180 / np.pi), -15, 15)
+    if Rover.features.rock_count > 0:
+        Rover.steer = np.clip(Rover.features.rock_angle_mean, -15, 15)
         Rover.mode = 'pickup'
 
     elif Rover.mode == 'stop':
@@ -215,7 +242,7 @@ def stop_mode(Rover):
         # If we're not moving (vel < 0.2) then do something else
         elif Rover.vel <= 0.2:
             # Now we're stopped and we have vision data to see if there's a path forward
-            if len(Rover.nav_angles) < Rover.go_forward:
+            if Rover.features.nav_count < Rover.go_forward:
                 Rover.throttle = 0
                 # Release the brake to allow turning
                 Rover.brake = 0
@@ -223,14 +250,13 @@ def stop_mode(Rover):
                 # when stopped the next line will induce 4-wheel turning
                 Rover.steer = -15  # Could be more clever here about which way to turn
             # If we're stopped but see sufficient navigable terrain in front then go!
-            if len(Rover.nav_angles) >= Rover.go_forward:
+            if Rover.features.nav_count >= Rover.go_forward:
                 # Set throttle back to stored value
                 Rover.throttle = Rover.throttle_set
                 # Release the brake
                 Rover.brake = 0
                 # Set steer to mean angle
-                Rover.steer = np.clip(
-                    np.mean(Rover.nav_angles * 180 / np.pi), -15, 15)
+                Rover.steer = np.clip(Rover.features.nav_angle_mean, -15, 15)
                 Rover.mode = 'forward'
     return Rover
 
@@ -238,27 +264,30 @@ def stop_mode(Rover):
 def decision_step(Rover):
     """Decision process for rover moving"""
     # Check if we have vision data to make decisions with
-    if Rover.nav_angles is not None:
+    features = Rover.features
+    if features is not None:
         if Rover.samples_found < 6:
             # Check for Rover.mode status
             if Rover.mode == 'pickup':
                 # Stop the rover and turn to rock
-                if len(Rover.rock_angles) > 0:
+                if features.rock_count > 0:
                     Rover = pickup_mode(Rover)
                 else:
                     Rover.mode = 'forward'
 
             elif Rover.mode == 'forward':
                 # Check if there is rock in front of rover
-                if len(Rover.rock_angles) > 0 and np.mean(Rover.rock_angles) > -0.25:
+                if features.rock_count > 0 and features.rock_angle_mean > -0.25 * 180 / np.pi:
                     Rover.mode = 'pickup'
 
                 # Check the extent of navigable terrain
-                elif len(Rover.nav_angles) >= Rover.stop_forward:
+                elif features.nav_count >= Rover.stop_forward:
                     # If mode is forward, navigable terrain looks good
                     # and velocity is below max, then throttle
-                    Rover.steer = left_side_mode(
-                        Rover.vision_image[:, :, 0], Rover.nav_angles)
+                    if Rover.explore:
+                        Rover.steer = explore_mode(Rover)
+                    else:
+                        Rover.steer = left_side_mode(features)
 
                     if Rover.vel < Rover.max_vel:
                         # Set a larger throttle value at begginging
@@ -274,7 +303,7 @@ def decision_step(Rover):
                     # run along with the left side, using the 65% large nav angle.
 
                 # If there's a lack of navigable terrain pixels then go to 'stop' mode
-                elif len(Rover.nav_angles) < Rover.stop_forward:
+                elif features.nav_count < Rover.stop_forward:
                     # Set mode to "stop" and hit the brakes!
                     Rover.throttle = 0
                     # Set brake to stored brake value
@@ -284,9 +313,8 @@ def decision_step(Rover):
 
             # If we're already in "stop" mode then make different decisions
             elif Rover.mode == 'stop':
-                if len(Rover.rock_angles) > 0 and np.mean(Rover.rock_angles) > -3:
-                    Rover.steer = np.clip(
-                        np.mean(Rover.rock_angles * 180 / np.pi), -15, 15)
+                if features.rock_count > 0 and features.rock_angle_mean > -3 * 180 / np.pi:
+                    Rover.steer = np.clip(features.rock_angle_mean, -15, 15)
                     Rover.mode = 'pickup'
                 # If we're in stop mode but still moving keep braking
                 if Rover.vel > 0.2:
@@ -296,7 +324,7 @@ def decision_step(Rover):
                 # If we're not moving (vel < 0.2) then do something else
                 elif Rover.vel <= 0.2:
                     # Now we're stopped and we have vision data to see if there's a path forward
-                    if len(Rover.nav_angles) < Rover.go_forward:
+                    if features.nav_count < Rover.go_forward:
                         Rover.throttle = 0
                         # Release the brake to allow turning
                         Rover.brake = 0
@@ -304,14 +332,13 @@ def decision_step(Rover):
                         # when stopped the next line will induce 4-wheel turning
                         Rover.steer = -15  # Could be more clever here about which way to turn
                     # If we're stopped but see sufficient navigable terrain in front then go!
-                    elif len(Rover.nav_angles) >= Rover.go_forward:
+                    elif features.nav_count >= Rover.go_forward:
                         # Set throttle back to stored value
                         Rover.throttle = Rover.throttle_set
                         # Release the brake
                         Rover.brake = 0
                         # Set steer to mean angle
-                        Rover.steer = np.clip(
-                            np.mean(Rover.nav_angles * 180 / np.pi), -15, 15)
+                        Rover.steer = np.clip(features.nav_angle_mean, -15, 15)
                         Rover.mode = 'forward'
 
         # If all samples are found
@@ -332,10 +359,8 @@ def decision_step(Rover):
                     Rover.brake = Rover.brake_set
                 print("Fineshed the task!")
                 # Clean the worldmap
-                cross_idx = ((Rover.worldmap[:, :, 2] > 0) & (
-                    Rover.worldmap[:, :, 0] > 0)).nonzero()
-                if len(cross_idx) > 0:
-                    Rover.worldmap[:, :, 0][cross_idx] = 0
+                if clean_obstacles(Rover.worldmap) > 0:
+                    Rover.map_stats.reset(Rover.worldmap)
 
     # Just to make the rover do something
     # even if no modifications have been made to the code
@@ -1,26 +1,26 @@
 # Do the necessary imports
 import argparse
+import atexit
 import shutil
-import base64
-from datetime import datetime
 import os
-import cv2
+import traceback
 import numpy as np
 import socketio
 import eventlet
 import eventlet.wsgi
-from PIL import Image
-from flask import Flask
-from io import BytesIO, StringIO
-import json
-import pickle
-import matplotlib.image as mpimg
+from eventlet import tpool
+from flask import Flask, Response
 import time
 
 # Import functions for perception and decision making
-from perception import perception_step
+from perception import perception_step, map_frame
+from perception_worker import PerceptionWorker
 from decision import decision_step
-from supporting_functions import update_rover, create_output_images
+from supporting_functions import update_rover, create_output_images, decode_image, RealClock
+from metrics import MetricsRegistry
+from recorder import TelemetryRecorder
+from worldmap import (MapStats, RockSamples, TiledMapStats, TiledWorldmap, open_worldmap,
+                      load_ground_truth)
 # Initialize socketio server and Flask application
 # (learn more at: https://python-socketio.readthedocs.io/en/latest/)
 sio = socketio.Server()
@@ -29,15 +29,32 @@ app = Flask(__name__)
 # Read in ground truth map and create 3-channel green version for overplotting
 # NOTE: images are read in by default with the origin (0, 0) in the upper left
 # and y-axis increasing downward.
-ground_truth = mpimg.imread('../calibration_images/map_bw.png')
-# This next line creates arrays of zeros in the red and blue channels
-# and puts the map into the green channel.  This is why the underlying
-# map output looks green in the display image
-ground_truth_3d = np.dstack((ground_truth*0, ground_truth*255, ground_truth*0)).astype(np.float)
+# The 3-channel version has zeros in the red and blue channels and the map
+# in the green channel.  This is why the underlying map output looks green
+# in the display image. Both are loaded from a cache kept next to the PNG,
+# found from this file so the server can start from any directory
+ground_truth_path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                 '..', 'calibration_images', 'map_bw.png')
+ground_truth, ground_truth_3d = load_ground_truth(ground_truth_path)
 
 # Define RoverState() class to retain rover state parameters
 class RoverState():
-    def __init__(self):
+    # Every field is declared here, assigning an unknown one is an error
+    __slots__ = ('clock', 'start_time', 'total_time', 'img', 'pos', 'yaw', 'pitch', 'roll',
+                 'vel', 'steer', 'throttle', 'brake', 'nav_angles', 'nav_dists',
+                 'ground_truth', 'mode', 'throttle_set', 'brake_set', 'stop_forward',
+                 'go_forward', 'max_vel', 'vision_image', 'worldmap', 'world_hits',
+                 'world_counts', 'map_stats', 'rock_samples', 'samples_pos', 'samples_to_find',
+                 'samples_found', 'near_sample', 'picking_up', 'send_pickup', 'frame_count',
+                 'log_every', 'dst_size', 'bottom_offset', 'source_points', 'obs_angles',
+                 'obs_dists', 'rock_dists', 'rock_angles', 'features',
+                 'weight_angles_by_distance', 'time_start', 'max_throttle', 'start_point',
+                 'turn_to_start', 'home_dist', 'angle_error', 'planner', 'waypoint_lookahead',
+                 'explore', 'explorer')
+
+    def __init__(self, clock=None):
+        # Clock read by update_rover and decision_step, real time by default
+        self.clock = clock if clock is not None else RealClock()
         self.start_time = None # To record the start time of navigation
         self.total_time = None # To record total duration of naviagation
         self.img = None # Current camera image
@@ -49,6 +66,8 @@ class RoverState():
         self.steer = 0 # Current steering angle
         self.throttle = 0 # Current throttle value
         self.brake = 0 # Current brake value
+        # Pixel polar coords of the last frame, nav_* and obs_*/rock_* below. They stay
+        # None with --perception-process, only features comes back from the worker
         self.nav_angles = None # Angles of navigable terrain pixels
         self.nav_dists = None # Distances of navigable terrain pixels
         self.ground_truth = ground_truth_3d # Ground truth worldmap
@@ -65,109 +84,413 @@ class RoverState():
         # Image output from perception step
         # Update this image to display your intermediate analysis steps
         # on screen in autonomous mode
-        self.vision_image = np.zeros((160, 320, 3), dtype=np.float)
+        self.vision_image = np.zeros((160, 320, 3), dtype=np.uint8)
         # Worldmap
         # Update this image with the positions of navigable terrain
-        # obstacles and rock samples
-        self.worldmap = np.zeros((200, 200, 3), dtype=np.float)
+        # obstacles and rock samples, as hit counts saturating at 65535
+        self.worldmap = np.zeros((200, 200, 3), dtype=np.uint16)
+        self.world_hits = None # Flat worldmap indices hit by the last frame, None with the worker
+        self.world_counts = None # Flat worldmap indices touched by the last frame, hits on each
+        # Mapping statistics and display overlay, updated with each frame's hits
+        self.map_stats = MapStats(self.worldmap, self.ground_truth)
+        # Known samples confirmed by rock detections on the worldmap
+        self.rock_samples = RockSamples()
         self.samples_pos = None # To store the actual sample positions
         self.samples_to_find = 0 # To store the initial count of samples
         self.samples_found = 0 # To count the number of samples found
         self.near_sample = 0 # Will be set to telemetry value data["near_sample"]
         self.picking_up = 0 # Will be set to telemetry value data["picking_up"]
         self.send_pickup = False # Set to True to trigger rock pickup
+        self.frame_count = 0 # Telemetry frames received
+        self.log_every = 0 # Print telemetry status every log_every frames, 0 for never
 
         # New added state
         self.dst_size = 5
         self.bottom_offset = 5
-        self.nav_angles = None  # Angles of navigable terrain pixels
-        self.nav_dists = None  # Distances of navigable terrain pixels
-        self.obj_angles = None  # Angles of obstacle pixels
-        self.obj_dists = None  # Distances of obstacle pixels
+        # Perspective transform source points in the camera image
+        self.source_points = np.float32([[14, 140], [300, 140], [200, 96], [119, 96]])
+        self.obs_angles = None  # Angles of obstacle pixels
+        self.obs_dists = None  # Distances of obstacle pixels
         self.rock_dists = None  # Distances of rock pixels
         self.rock_angles = None  # Angles of rock pixels
-        self.time_start = time.time() # Initial start time from rover stuck
+        self.features = None # FrameFeatures of the last frame, read by decision_step
+        self.weight_angles_by_distance = False # Weight the nav angle histogram by pixel distance
+        self.time_start = self.clock.time() # Initial start time from rover stuck
         self.max_throttle = 1 # Maximum throttle
         self.start_point = (99.7, 85.6) # Initial start point
         self.turn_to_start = False # Initial turning state at beginning of back home
         self.home_dist = 0 # Distance to home point
-        self.angle_error = 0 # Yaw angle error to home point
+        self.angle_error = 0 # Yaw angle error to the next waypoint home
+        self.planner = None # Path planner home, created when the return starts
+        self.waypoint_lookahead = 4 # Waypoints ahead of the rover to steer toward
+        self.explore = False # Explore frontiers instead of following the left side
+        self.explorer = None # Frontier index and targets, created when exploring starts
 
-# Initialize our rover
-Rover = RoverState()
+# Options of the RoverState of each session, set from the command line
+rover_options = {'log_every': 0, 'explore': False, 'world_size': 0, 'tile_size': 64}
 
-# Variables to track frames per second (FPS)
-# Intitialize frame counter
-frame_counter = 0
-# Initalize second counter
-second_counter = time.time()
-fps = None
 
+def new_rover(worldmap=None):
+    """Initialize the rover of a new session.
+    worldmap is a worldmap kept in a file, to map into instead of a new one"""
+    Rover = RoverState()
+    Rover.log_every = rover_options['log_every']
+    Rover.explore = rover_options['explore']
+    if worldmap is not None:
+        Rover.worldmap = worldmap
+        Rover.map_stats.reset(worldmap)
+    elif rover_options['world_size'] > 0:
+        Rover.worldmap = TiledWorldmap(rover_options['world_size'], rover_options['tile_size'])
+        Rover.map_stats = TiledMapStats(Rover.worldmap, Rover.ground_truth)
+    return Rover
 
-# Define telemetry function for what to do with incoming data
-@sio.on('telemetry')
-def telemetry(sid, data):
+# Latency and frame counters of the telemetry loop, served on /metrics.
+# Latency, fps and mode series carry a session label (the socketio sid)
+# and are removed when the session closes
+metrics = MetricsRegistry()
+metrics.describe('stage_latency_seconds', 'Latency of each telemetry stage')
+metrics.describe('frame_latency_seconds', 'Latency from telemetry received to commands sent')
+metrics.describe('frames_total', 'Telemetry frames received')
+metrics.describe('frames_dropped_total', 'Telemetry frames not acted on')
+metrics.describe('frames_late_total', 'Frames slower than the latency budget')
+metrics.describe('fps', 'Telemetry frames per second')
+metrics.describe('mode', 'Current decision mode')
+metrics.describe('sessions', 'Connected simulator sessions')
+# Frames slower than this are counted as late (seconds)
+late_frame_budget = 0.05
 
-    global frame_counter, second_counter, fps
-    frame_counter+=1
-    # Do a rough calculation of frames per second (FPS)
-    if (time.time() - second_counter) > 1:
-        fps = frame_counter
-        frame_counter = 0
-        second_counter = time.time()
-    print("Current FPS: {}".format(fps))
 
-    if data:
-        global Rover
-        # Initialize / update Rover with current telemetry
-        Rover, image = update_rover(Rover, data)
+class InsetRenderer():
+    """Render the inset images in a green thread at a limited rate.
+    telemetry() sends the most recent finished insets with its commands,
+    so the control path does not wait for the JPEG encoding.
+    With a rate of 0 the insets are rendered for every frame instead."""
+
+    def __init__(self, rate=5, sid=None):
+        self.rate = rate  # Renders per second
+        self.sid = sid  # Session the insets are rendered for
+        self.images = ('', '')  # Most recent map and vision insets
+        self.pending = None  # Rover waiting to be rendered
+        self.running = False
+
+    def start(self):
+        if self.rate > 0:
+            self.running = True
+            eventlet.spawn(self.run)
+
+    def stop(self):
+        self.running = False
+        self.pending = None
+
+    def run(self):
+        while self.running:
+            eventlet.sleep(1 / self.rate)
+            if self.pending is not None:
+                Rover, self.pending = self.pending, None
+                self.render(Rover)
+
+    def render(self, Rover):
+        with metrics.time('stage_latency_seconds', stage='create_output_images',
+                          session=self.sid):
+            self.images = create_output_images(Rover)
+
+    def latest(self, Rover):
+        """Insets to send with this frame's commands"""
+        if not self.running:
+            self.render(Rover)
+        return self.images
+
+    def request(self, Rover):
+        """Ask for the insets to be rendered from this Rover state"""
+        if self.running:
+            self.pending = Rover
+
+
+# Inset renders per second of each session
+render_rate = 5
+
+
+@app.route('/metrics')
+def metrics_endpoint():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+class TelemetryPipeline():
+    """Latest-frame-wins telemetry processing of a session.
+    telemetry() only keeps the newest frame, frames replaced before they
+    were picked up are dropped and counted. The next frame is decoded in
+    a worker thread while the current one goes through perception and
+    decision, so at most one frame waits behind the one being processed."""
+
+    def __init__(self, session):
+        self.session = session
+        self.latest = None  # Newest (data, received time) not picked up yet
+        self.arrived = eventlet.event.Event()
+        # Two frame buffers, one decoding while the other is processed
+        self.buffers = [None, None]
+        self.next_buffer = 0
+        self.running = False
+
+    def start(self):
+        self.running = True
+        session_pool.spawn(self.run)
 
-        if np.isfinite(Rover.vel):
+    def stop(self):
+        self.running = False
+        if not self.arrived.ready():
+            self.arrived.send()
 
-            # Execute the perception and decision steps to update the Rover's state
-            Rover = perception_step(Rover)
+    def put(self, data, received):
+        """Keep only the newest frame"""
+        if self.latest is not None:
+            metrics.inc('frames_dropped_total', reason='superseded')
+        self.latest = (data, received)
+        if not self.arrived.ready():
+            self.arrived.send()
+
+    def decode_next(self):
+        """Wait for a frame and decode it in a worker thread,
+        or decode and project it in the perception worker process.
+        A frame that fails to decode is dropped and the next one waited for.
+        Output: None once the pipeline is stopped"""
+        while True:
+            while self.latest is None and self.running:
+                self.arrived.wait()
+                self.arrived = eventlet.event.Event()
+            if not self.running:
+                return None
+            (data, received), self.latest = self.latest, None
+            try:
+                return (data, received) + self.decode(data)
+            except Exception:
+                drop_frame(self.session, data)
+
+    def decode(self, data):
+        """Output: decoded image and perception worker projection of a frame"""
+        worker = self.session.perception_worker
+        if worker is not None:
+            with metrics.time('stage_latency_seconds', stage='project_frame',
+                              session=self.session.sid):
+                return worker.project(data, self.session.Rover)
+        index = self.next_buffer
+        self.next_buffer = 1 - index
+        with metrics.time('stage_latency_seconds', stage='decode', session=self.session.sid):
+            decoded = tpool.execute(decode_image, data["image"], self.buffers[index])
+        self.buffers[index] = decoded[0]
+        return decoded, None
+
+    def run(self):
+        frame = eventlet.spawn(self.decode_next).wait()
+        while frame is not None:
+            # Start decoding the next frame while this one is processed
+            decoding = eventlet.spawn(self.decode_next)
+            eventlet.sleep(0)
+            try:
+                process_frame(self.session, *frame)
+            except Exception:
+                # One bad frame must not end the session
+                drop_frame(self.session, frame[0], frame[3])
+            frame = decoding.wait()
+        # The session is closed and its last frame processed
+        if self.session.perception_worker is not None:
+            self.session.perception_worker.release(self.session.Rover)
+        metrics.remove(session=self.session.sid)
+
+
+def checkpoint_worldmap(worldmap, interval):
+    """Flush a memory-mapped worldmap to disk every interval seconds.
+    Written cells survive a crash of this process anyway, the
+    checkpoints bound what a crash of the machine can lose."""
+    while True:
+        eventlet.sleep(interval)
+        worldmap.flush()
+
+
+class Session():
+    """Rover state and telemetry processing of one connected simulator.
+    Telemetry frames are processed apart from the socketio handler,
+    unless serial is set."""
+
+    def __init__(self, sid, serial=False, lead=False):
+        self.sid = sid
+        # The lead session records the run and maps into the --worldmap file
+        self.lead = lead
+        self.Rover = new_rover(worldmap_file if lead else None)
+        self.renderer = InsetRenderer(render_rate, sid)
+        # Perception worker process projecting this session's frames, if any
+        self.perception_worker = assign_perception_worker()
+        # Frames per second of this session, counted over about a second
+        self.frame_counter = 0
+        self.second_counter = time.time()
+        self.pipeline = TelemetryPipeline(self)
+        self.renderer.start()
+        if not serial:
+            self.pipeline.start()
+
+    def count_frame(self):
+        """Count a telemetry frame and update the fps gauge every second"""
+        self.frame_counter += 1
+        if (time.time() - self.second_counter) > 1:
+            metrics.set('fps', self.frame_counter, session=self.sid)
+            self.frame_counter = 0
+            self.second_counter = time.time()
+
+    def close(self):
+        # A running pipeline releases the perception worker slot
+        # and removes the session's metrics itself
+        if not self.pipeline.running:
+            if self.perception_worker is not None:
+                self.perception_worker.release(self.Rover)
+            metrics.remove(session=self.sid)
+        self.pipeline.stop()
+        self.renderer.stop()
+
+
+# Sessions by socketio session id
+sessions = {}
+# Runs the telemetry pipelines of the sessions
+session_pool = eventlet.GreenPool(8)
+# Process every telemetry frame in the socketio handler
+serial = False
+# Records the run in the background when an image folder is given
+recorder = None
+# Worldmap kept in a file when one is given, mapped into by the lead session
+worldmap_file = None
+# Decode and project camera frames in other processes when started
+perception_workers = []
+
+
+def assign_perception_worker():
+    """Perception worker for a new session, the one with the fewest
+    sessions. Sessions on different workers are projected in parallel.
+    Output: None when there are no perception workers"""
+    if not perception_workers:
+        return None
+    return min(perception_workers, key=lambda worker: sum(
+        session.perception_worker is worker for session in sessions.values()))
+
+
+def process_frame(session, data, received, decoded=None, projection=None):
+    """Run one telemetry frame of a session through perception and
+    decision and send the commands to its rover. projection is the
+    frame projected by the perception worker, if it is running"""
+    Rover = session.Rover
+    worker = session.perception_worker
+    if worker is not None and projection is None:
+        with metrics.time('stage_latency_seconds', stage='project_frame', session=session.sid):
+            decoded, projection = worker.project(data, Rover)
+    # Initialize / update Rover with current telemetry
+    with metrics.time('stage_latency_seconds', stage='update_rover', session=session.sid):
+        Rover, image = update_rover(Rover, data, decoded)
+        if projection is not None:
+            Rover = worker.apply(Rover, projection)
+
+    if np.isfinite(Rover.vel):
+
+        # Execute the perception and decision steps to update the Rover's state
+        with metrics.time('stage_latency_seconds', stage='perception_step', session=session.sid):
+            if projection is not None:
+                # Only the worldmap is left to update
+                Rover = map_frame(Rover)
+            else:
+                Rover = perception_step(Rover)
+        with metrics.time('stage_latency_seconds', stage='decision_step', session=session.sid):
             Rover = decision_step(Rover)
+        metrics.set_state('mode', Rover.mode, session=session.sid)
 
-            # Create output images to send to server
-            out_image_string1, out_image_string2 = create_output_images(Rover)
+        # Output images to send to server, the most recent rendered ones
+        out_image_string1, out_image_string2 = session.renderer.latest(Rover)
 
-            # The action step!  Send commands to the rover!
-            commands = (Rover.throttle, Rover.brake, Rover.steer)
-            send_control(commands, out_image_string1, out_image_string2)
+        # The action step!  Send commands to the rover!
+        commands = (Rover.throttle, Rover.brake, Rover.steer)
+        with metrics.time('stage_latency_seconds', stage='send_control', session=session.sid):
+            send_control(session.sid, commands, out_image_string1, out_image_string2,
+                         data.get('frame_id'))
+        # Render new insets from this state off the control path
+        session.renderer.request(Rover)
 
-            # If in a state where want to pickup a rock send pickup command
-            if Rover.send_pickup and not Rover.picking_up:
-                send_pickup()
-                # Reset Rover flags
-                Rover.send_pickup = False
-        # In case of invalid telemetry, send null commands
-        else:
+        # If in a state where want to pickup a rock send pickup command
+        if Rover.send_pickup and not Rover.picking_up:
+            send_pickup(session.sid)
+            # Reset Rover flags
+            Rover.send_pickup = False
+
+        frame_latency = time.perf_counter() - received
+        metrics.observe('frame_latency_seconds', frame_latency, session=session.sid)
+        if frame_latency > late_frame_budget:
+            metrics.inc('frames_late_total')
+    # In case of invalid telemetry, send null commands
+    else:
+        metrics.inc('frames_dropped_total', reason='invalid')
+
+        # Send zeros for throttle, brake and steer and empty images
+        send_control(session.sid, (0, 0, 0), '', '', data.get('frame_id'))
+
+    # If you want to save camera images from autonomous driving specify a path
+    # Example: $ python drive_rover.py image_folder_path
+    # Frames are queued for the recorder if a folder was specified
+    if recorder is not None and session.lead:
+        if not recorder.record(data, image):
+            metrics.inc('frames_dropped_total', reason='recorder')
 
-            # Send zeros for throttle, brake and steer and empty images
-            send_control((0, 0, 0), '', '')
 
-        # If you want to save camera images from autonomous driving specify a path
-        # Example: $ python drive_rover.py image_folder_path
-        # Conditional to save image frame if folder was specified
-        if args.image_folder != '':
-            timestamp = datetime.utcnow().strftime('%Y_%m_%d_%H_%M_%S_%f')[:-3]
-            image_filename = os.path.join(args.image_folder, timestamp)
-            image.save('{}.jpg'.format(image_filename))
+def drop_frame(session, data, projection=None):
+    """Log the error a frame failed with and send null commands for it.
+    projection is the frame projected by the perception worker, if any"""
+    traceback.print_exc()
+    metrics.inc('frames_dropped_total', reason='error')
+    if projection is not None:
+        session.perception_worker.discard(projection)
+    send_control(session.sid, (0, 0, 0), '', '', data.get('frame_id'))
+
+
+# Define telemetry function for what to do with incoming data
+@sio.on('telemetry')
+def telemetry(sid, data):
+    received = time.perf_counter()
+    metrics.inc('frames_total')
+    session = sessions.get(sid)
+    if session is None:
+        return
+    # Do a rough calculation of frames per second (FPS)
+    session.count_frame()
+    if data:
+        # Hand the frame to the session's pipeline, or process it
+        # right away when the pipeline is not running
+        if session.pipeline.running:
+            session.pipeline.put(data, received)
+        else:
+            process_frame(session, data, received)
 
     else:
-        sio.emit('manual', data={}, skip_sid=True)
+        sio.emit('manual', data={}, room=sid)
 
 @sio.on('connect')
 def connect(sid, environ):
+    if len(sessions) >= session_pool.size:
+        print("refusing ", sid, "all", session_pool.size, "sessions are in use")
+        return False
     print("connect ", sid)
-    send_control((0, 0, 0), '', '')
+    # The first session to connect while there is no lead session leads
+    lead = not any(session.lead for session in sessions.values())
+    sessions[sid] = Session(sid, serial, lead)
+    metrics.set('sessions', len(sessions))
+    send_control(sid, (0, 0, 0), '', '')
     sample_data = {}
     sio.emit(
         "get_samples",
         sample_data,
-        skip_sid=True)
+        room=sid)
 
-def send_control(commands, image_string1, image_string2):
+@sio.on('disconnect')
+def disconnect(sid):
+    print("disconnect ", sid)
+    session = sessions.pop(sid, None)
+    if session is not None:
+        session.close()
+    metrics.set('sessions', len(sessions))
+
+def send_control(sid, commands, image_string1, image_string2, frame_id=None):
     # Define commands to be sent to the rover
     data={
         'throttle': commands[0].__str__(),
@@ -176,20 +499,23 @@ def send_control(commands, image_string1, image_string2):
         'inset_image1': image_string1,
         'inset_image2': image_string2,
         }
+    # Echo the frame id of replayed telemetry (see sim_client.py)
+    if frame_id is not None:
+        data['frame_id'] = frame_id
     # Send commands via socketIO server
     sio.emit(
         "data",
         data,
-        skip_sid=True)
+        room=sid)
     eventlet.sleep(0)
 # Define a function to send the "pickup" command
-def send_pickup():
+def send_pickup(sid):
     print("Picking up")
     pickup = {}
     sio.emit(
         "pickup",
         pickup,
-        skip_sid=True)
+        room=sid)
     eventlet.sleep(0)
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Remote Driving')
@@ -198,9 +524,92 @@ if __name__ == '__main__':
         type=str,
         nargs='?',
         default='',
-        help='Path to image folder. This is where the images from the run will be saved.'
+        help='Path to image folder. This is where the run will be recorded as an archive '
+             '(extract it with recorder.py).'
+    )
+    parser.add_argument(
+        '--late-ms',
+        type=float,
+        default=50,
+        help='Frames slower than this many milliseconds are counted as late on /metrics.'
+    )
+    parser.add_argument(
+        '--render-rate',
+        type=float,
+        default=5,
+        help='Inset images rendered per second, 0 renders them for every frame.'
+    )
+    parser.add_argument(
+        '--log-every',
+        type=int,
+        default=0,
+        help='Print the telemetry status every N frames, 0 for never.'
+    )
+    parser.add_argument(
+        '--serial',
+        action='store_true',
+        help='Process every telemetry frame in the socketio handler, without dropping frames.'
+    )
+    parser.add_argument(
+        '--worldmap',
+        type=str,
+        default='',
+        help='Path of a .npy file to keep the worldmap in. Mapping resumes '
+             'from the file if it exists.'
+    )
+    parser.add_argument(
+        '--checkpoint-interval',
+        type=float,
+        default=10,
+        help='Seconds between flushes of the --worldmap file to disk.'
+    )
+    parser.add_argument(
+        '--explore',
+        action='store_true',
+        help='Explore toward the nearest unmapped frontier instead of following the left side.'
+    )
+    parser.add_argument(
+        '--world-size',
+        type=int,
+        default=0,
+        help='Map a world of this many cells a side in a sparse tiled worldmap, '
+             '0 keeps the dense 200x200 worldmap.'
+    )
+    parser.add_argument(
+        '--tile-size',
+        type=int,
+        default=64,
+        help='Cells a side of the tiles of a --world-size worldmap.'
+    )
+    parser.add_argument(
+        '--max-sessions',
+        type=int,
+        default=8,
+        help='Number of simulators that can be connected at once, each drives its own rover.'
+    )
+    parser.add_argument(
+        '--perception-process',
+        action='store_true',
+        help='Decode and project camera frames in worker processes, '
+             'so that they do not hold up the socketio event loop.'
+    )
+    parser.add_argument(
+        '--perception-workers',
+        type=int,
+        default=0,
+        help='Number of --perception-process workers, each session is projected by one of '
+             'them. 0 starts one per session, up to the number of CPUs.'
     )
     args = parser.parse_args()
+    # Checked before anything is set up, so a bad combination changes nothing
+    if args.world_size > 0 and args.worldmap != '':
+        parser.error('--worldmap files hold dense worldmaps, not --world-size ones')
+    late_frame_budget = args.late_ms / 1000
+    render_rate = args.render_rate
+    serial = args.serial
+    session_pool.resize(args.max_sessions)
+    rover_options.update(log_every=args.log_every, explore=args.explore,
+                         world_size=args.world_size, tile_size=args.tile_size)
 
     #os.system('rm -rf IMG_stream/*')
     if args.image_folder != '':
@@ -210,10 +619,38 @@ if __name__ == '__main__':
         else:
             shutil.rmtree(args.image_folder)
             os.makedirs(args.image_folder)
+        recorder = TelemetryRecorder(args.image_folder)
+        atexit.register(recorder.close)
         print("Recording this run ...")
     else:
         print("NOT recording this run ...")
 
+    # Sessions are set up like this rover
+    Rover = new_rover()
+    if args.worldmap != '':
+        resumed = os.path.exists(args.worldmap)
+        worldmap_file = open_worldmap(args.worldmap, Rover.worldmap.shape, Rover.worldmap.dtype)
+        atexit.register(worldmap_file.flush)
+        eventlet.spawn(checkpoint_worldmap, worldmap_file, args.checkpoint_interval)
+        if resumed:
+            print("Resuming worldmap from {} ({}% mapped)".format(
+                args.worldmap, MapStats(worldmap_file, ground_truth_3d).perc_mapped))
+        else:
+            print("Keeping worldmap in {}".format(args.worldmap))
+
+    if args.perception_process:
+        workers = args.perception_workers or min(args.max_sessions, os.cpu_count() or 1)
+        # The workers project into the worldmap shape of the sessions. Each session
+        # needs three slots: the frame applied to its rover, the frame waiting
+        # to be processed and the frame being projected
+        slots = 3 * -(-args.max_sessions // workers)
+        for _ in range(workers):
+            worker = PerceptionWorker(Rover, slots)
+            worker.start()
+            atexit.register(worker.close)
+            perception_workers.append(worker)
+        print("Projecting camera frames in {} worker processes".format(workers))
+
     # wrap Flask application with socketio's middleware
     app = socketio.Middleware(sio, app)
 
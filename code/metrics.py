@@ -0,0 +1,117 @@
+import bisect
+import time
+from contextlib import contextmanager
+
+# In-process metrics for the telemetry loop, rendered in the
+# Prometheus text format by the /metrics route of drive_rover.py
+
+# Latency histogram bucket upper bounds in seconds
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+
+class Histogram():
+    """Fixed bucket histogram, observing is a bisect and two additions"""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # Last count is the +Inf bucket
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+def _label_string(labels):
+    """Format a (name, value) label tuple as {name="value",...}"""
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, value) for name, value in labels) + '}'
+
+
+class MetricsRegistry():
+    """Registry of counters, gauges and histograms.
+    Metrics are created on first use and keyed by name and labels."""
+
+    def __init__(self, prefix='rover_'):
+        self.prefix = prefix
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.help = {}
+
+    def describe(self, name, text):
+        """Set the help text of a metric"""
+        self.help[name] = text
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        self.gauges[key] = value
+
+    def set_state(self, name, state, **labels):
+        """Set a state gauge: 1 for the current state, 0 for the ones seen before"""
+        others = tuple(sorted(labels.items()))
+        for key in self.gauges:
+            if key[0] == name and tuple(item for item in key[1] if item[0] != 'state') == others:
+                self.gauges[key] = 0
+        self.set(name, 1, state=state, **labels)
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram()
+        histogram.observe(value)
+
+    def remove(self, **labels):
+        """Delete every series with these labels, e.g. those of a closed session"""
+        items = set(labels.items())
+        for series in (self.counters, self.gauges, self.histograms):
+            for key in [key for key in series if items <= set(key[1])]:
+                del series[key]
+
+    @contextmanager
+    def time(self, name, **labels):
+        """Observe the duration of the with block in seconds"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def _header(self, lines, name, kind, seen):
+        if name not in seen:
+            seen.add(name)
+            if name in self.help:
+                lines.append('# HELP {}{} {}'.format(self.prefix, name, self.help[name]))
+            lines.append('# TYPE {}{} {}'.format(self.prefix, name, kind))
+
+    def render(self):
+        """Render every metric in the Prometheus text format"""
+        lines = []
+        seen = set()
+        for (name, labels), value in sorted(self.counters.items()):
+            self._header(lines, name, 'counter', seen)
+            lines.append('{}{}{} {}'.format(self.prefix, name, _label_string(labels), value))
+        for (name, labels), value in sorted(self.gauges.items()):
+            self._header(lines, name, 'gauge', seen)
+            lines.append('{}{}{} {}'.format(self.prefix, name, _label_string(labels), value))
+        for (name, labels), histogram in sorted(self.histograms.items()):
+            self._header(lines, name, 'histogram', seen)
+            cumulative = 0
+            bounds = [str(bound) for bound in histogram.buckets] + ['+Inf']
+            for bound, count in zip(bounds, histogram.counts):
+                cumulative += count
+                lines.append('{}{}_bucket{} {}'.format(
+                    self.prefix, name, _label_string(labels + (('le', bound),)), cumulative))
+            lines.append('{}{}_sum{} {}'.format(
+                self.prefix, name, _label_string(labels), histogram.sum))
+            lines.append('{}{}_count{} {}'.format(
+                self.prefix, name, _label_string(labels), histogram.count))
+        return '\n'.join(lines) + '\n'
@@ -1,5 +1,6 @@
 import numpy as np
 import cv2
+from worldmap import world_hits, count_hits, add_hit_counts
 
 # Identify pixels above the threshold
 # Threshold of RGB > 160 does a nice job of identifying ground pixels only
@@ -104,8 +105,8 @@ def rover_coords(binary_img):
     ypos, xpos = binary_img.nonzero()
     # Calculate pixel positions with reference to the rover position being at the
     # center bottom of the image.
-    x_pixel = np.absolute(ypos - binary_img.shape[0]).astype(np.float)
-    y_pixel = -(xpos - binary_img.shape[0]).astype(np.float)
+    x_pixel = np.absolute(ypos - binary_img.shape[0]).astype(float)
+    y_pixel = -(xpos - binary_img.shape[0]).astype(float)
     return x_pixel, y_pixel
 
 
@@ -143,19 +144,53 @@ def translate_pix(xpix_rot, ypix_rot, xpos, ypos, scale):
     return xpix_translated, ypix_translated
 
 
-def pix_to_world(xpix, ypix, xpos, ypos, yaw, world_size, scale):
+def pix_to_world(xpix, ypix, xpos, ypos, yaw, scale):
     """Combine the rotate_pix and translate_pix functions
-    to perform world coordinates transform"""
+    to perform world coordinates transform.
+    Coords are not clipped, world_hits drops the ones off the worldmap."""
     # Apply rotation
     xpix_rot, ypix_rot = rotate_pix(xpix, ypix, yaw)
     # Apply translation
     xpix_tran, ypix_tran = translate_pix(xpix_rot, ypix_rot, xpos, ypos, scale)
-    # Perform rotation, translation and clipping all at once
-    x_pix_world = np.clip(np.int_(xpix_tran), 0, world_size - 1)
-    y_pix_world = np.clip(np.int_(ypix_tran), 0, world_size - 1)
+    # Convert to worldmap cells
+    x_pix_world = np.int_(xpix_tran)
+    y_pix_world = np.int_(ypix_tran)
     # Return the result
     return x_pix_world, y_pix_world
 
+
+def segment_image(img, terrain_thresh=(160, 160, 160),
+                  obstacle_thresh=([70, 70, 70], [160, 160, 160]),
+                  rock_hsv_thresh=([20, 65, 130], [28, 255, 230])):
+    """Select terrain, rock and obstacle pixels in a single pass.
+    Same selection as color_thresh, rock_thresh_hsv and obstacle_thresh,
+    but the bands are sliced instead of masked with region_of_interest.
+    Output: uint8 label image with one channel per class, in the same
+    order as Rover.vision_image: obstacle (0/1), rock (0/255), terrain (0/1).
+    Sky pixels are zero in every channel."""
+    rows, cols = img.shape[:2]
+    labels = np.empty((rows, cols, 3), dtype=np.uint8)
+    # Terrain is only selected in the bottom 70% of the image,
+    # sky only in the upper 40% (fillPoly includes the boundary row)
+    terrain_top = int(rows * 0.3)
+    sky_bottom = int(rows * 0.4) + 1
+    # Require that each pixel be above all three threshold values in RGB
+    low_threshold = np.array(terrain_thresh, dtype="uint8") + 1
+    high_threshold = np.array([255, 255, 255], dtype="uint8")
+    terrain_select = cv2.inRange(img[terrain_top:], low_threshold, high_threshold)
+    labels[:terrain_top, :, 2] = 0
+    np.bitwise_and(terrain_select, 1, out=labels[terrain_top:, :, 2])
+    # Obstacle is the reverse of sky and terrain
+    sky_select = cv2.inRange(img[:sky_bottom], np.array(obstacle_thresh[0], dtype="uint8"),
+                             np.array(obstacle_thresh[1], dtype="uint8"))
+    np.subtract(1, labels[:, :, 2], out=labels[:, :, 0])
+    np.bitwise_and(labels[:sky_bottom, :, 0], np.invert(sky_select),
+                   out=labels[:sky_bottom, :, 0])
+    # Rock samples are selected on the whole image with hsv color
+    labels[:, :, 1] = rock_thresh_hsv(img, rock_hsv_thresh)
+    return labels
+
+
 # Define a function to perform a perspective transform
 
 
@@ -169,22 +204,132 @@ def perspect_transform(img, src, dst):
     return warped
 
 
+def destination_points(img_shape, dst_size, bottom_offset):
+    """Destination points of the perspective transform,
+    a 2*dst_size square just above the bottom center of the image"""
+    rows, cols = img_shape[:2]
+    return np.float32([[cols / 2 - dst_size, rows - bottom_offset],
+                       [cols / 2 + dst_size, rows - bottom_offset],
+                       [cols / 2 + dst_size, rows - 2 * dst_size - bottom_offset],
+                       [cols / 2 - dst_size, rows - 2 * dst_size - bottom_offset]])
+
+
+class CameraGeometry():
+    """Cache of the perspective transform geometry.
+    The matrix and the remap tables only depend on the image shape,
+    dst_size, bottom_offset and the source points; they are rebuilt
+    when any of those change, so warping is a table lookup per frame.
+    The warped grid is fixed too, so the rover-centric and polar coords
+    of every warped pixel are kept as float32 tables."""
+
+    def __init__(self):
+        self.key = None
+        self.matrix = None  # Perspective transform matrix
+        self.map_x = None  # Source x coordinate of every warped pixel
+        self.map_y = None  # Source y coordinate of every warped pixel
+        self.x_pixel = None  # Rover-centric x of every warped pixel
+        self.y_pixel = None  # Rover-centric y of every warped pixel
+        self.dists = None  # Distance of every warped pixel
+        self.angles = None  # Angle of every warped pixel
+
+    def update(self, img_shape, dst_size, bottom_offset, source):
+        """Rebuild the cached geometry if the calibration changed"""
+        source = np.float32(source)
+        key = (tuple(img_shape[:2]), dst_size, bottom_offset, source.tobytes())
+        if key != self.key:
+            rows, cols = img_shape[:2]
+            destination = destination_points(img_shape, dst_size, bottom_offset)
+            self.matrix = cv2.getPerspectiveTransform(source, destination)
+            # warpPerspective samples the source image at M^-1 * (x, y, 1)
+            inverse = np.linalg.inv(self.matrix)
+            ypos, xpos = np.indices((rows, cols), dtype=np.float64)
+            w = inverse[2, 0] * xpos + inverse[2, 1] * ypos + inverse[2, 2]
+            self.map_x = ((inverse[0, 0] * xpos + inverse[0, 1] * ypos + inverse[0, 2]) / w
+                          ).astype(np.float32)
+            self.map_y = ((inverse[1, 0] * xpos + inverse[1, 1] * ypos + inverse[1, 2]) / w
+                          ).astype(np.float32)
+            # Same as rover_coords and to_polar_coords on every pixel
+            x_pixel = np.absolute(ypos - rows)
+            y_pixel = -(xpos - rows)
+            dists, angles = to_polar_coords(x_pixel, y_pixel)
+            self.x_pixel = x_pixel.astype(np.float32)
+            self.y_pixel = y_pixel.astype(np.float32)
+            self.dists = dists.astype(np.float32)
+            self.angles = angles.astype(np.float32)
+            self.key = key
+        return self
+
+    def warp(self, img):
+        """Same as perspect_transform with the cached remap tables"""
+        return cv2.remap(img, self.map_x, self.map_y, cv2.INTER_LINEAR)
+
+    def lookup(self, binary_img):
+        """Look up the coords of the nonzero pixels of a warped binary image
+        Output: x_pixel, y_pixel, dist, angles"""
+        select = binary_img != 0
+        return self.x_pixel[select], self.y_pixel[select], self.dists[select], self.angles[select]
+
+
+# Geometry shared by every perception_step call
+camera_geometry = CameraGeometry()
+
+
+class FrameFeatures():
+    """The per-frame values decision_step reads, computed once here
+    so that decisions cost the same however many pixels are visible.
+    Nav angles are kept as a histogram of 1 degree bins, weighted by
+    nav_dists when it is given. Angles are in degrees."""
+
+    def __init__(self, nav_angles, rock_angles, obstacle_select, nav_dists=None):
+        self.nav_count = len(nav_angles)
+        self.rock_count = len(rock_angles)
+        nav_degrees = nav_angles * 180 / np.pi
+        # Rover-centric angles lie in [-90, 90], bin i holds [i - 90, i - 89)
+        bins = np.clip((nav_degrees + 90).astype(np.intp), 0, 179)
+        self.nav_angle_hist = np.bincount(bins, weights=nav_dists, minlength=180)
+        self._nav_angle_cumsum = None
+        self.nav_angle_mean = 0.0
+        if self.nav_count:
+            self.nav_angle_mean = float(np.average(nav_degrees, weights=nav_dists))
+        self.rock_angle_mean = 0.0
+        if self.rock_count:
+            self.rock_angle_mean = float(np.mean(rock_angles * 180 / np.pi))
+        # Summed-area table of the obstacle pixels of the vision image
+        self.obstacle_table = cv2.integral(obstacle_select)
+
+    def nav_angle_quantile(self, percent):
+        """Percentile of the nav angles from the histogram,
+        interpolated inside its bin, so within a bin of np.percentile"""
+        if self._nav_angle_cumsum is None:
+            self._nav_angle_cumsum = np.cumsum(self.nav_angle_hist)
+        cumsum = self._nav_angle_cumsum
+        if cumsum[-1] == 0:
+            return 0.0
+        target = percent / 100 * cumsum[-1]
+        idx = min(int(np.searchsorted(cumsum, target)), len(cumsum) - 1)
+        before = cumsum[idx - 1] if idx else 0
+        if self.nav_angle_hist[idx] == 0:
+            return float(idx - 90)
+        return float(idx - 90 + (target - before) / self.nav_angle_hist[idx])
+
+    def obstacle_count(self, top, bottom, left, right):
+        """Obstacle pixels in vision_image[top:bottom, left:right]"""
+        table = self.obstacle_table
+        return int(table[bottom, right] - table[top, right] - table[bottom, left] + table[top, left])
+
+
 # Apply the above functions in succession and update the Rover state accordingly
-def perception_step(Rover):
-    """Perform perception steps to update Rover()"""
+def project_frame(Rover):
+    """Perform perception steps on the current camera image,
+    without touching Rover.worldmap. The worldmap cells hit by
+    this frame are stored in Rover.world_hits, and counted per cell
+    in Rover.world_counts."""
     # NOTE: camera image is coming to you in Rover.img
     img = Rover.img
-    # 1) Define source and destination points for perspective transform
-    dst_size = Rover.dst_size
-    bottom_offset = Rover.bottom_offset
-    source = np.float32([[14, 140], [300, 140], [200, 96], [119, 96]])
-    destination = np.float32([[img.shape[1] / 2 - dst_size, img.shape[0] - bottom_offset],
-                              [img.shape[1] / 2 + dst_size,
-                               img.shape[0] - bottom_offset],
-                              [img.shape[1] / 2 + dst_size, img.shape[0] -
-                               2 * dst_size - bottom_offset],
-                              [img.shape[1] / 2 - dst_size, img.shape[0] -
-                               2 * dst_size - bottom_offset]])
+    # 1) Look up the perspective transform geometry, it is only
+    # recomputed when the calibration changes
+    geometry = camera_geometry.update(img.shape, Rover.dst_size,
+                                      Rover.bottom_offset, Rover.source_points)
 
     # 2) Apply color threshold to identify navigable terrain/obstacles/rock samples
     terrain_threshold = (160, 160, 160)  # (130,120,100)
@@ -192,49 +337,76 @@ def perception_step(Rover):
     # rock_threshold = ([100, 100, 0], [200, 200, 50])
     rock_hsv_thresh = ([20, 65, 130], [28, 255, 230])
 
-    terrain_select = color_thresh(img, terrain_threshold)
-    # rock_select = rock_thresh(img, rock_threshold)
-    rock_select = rock_thresh_hsv(img, rock_hsv_thresh)
-    obstacle_select = obstacle_thresh(img, terrain_select, obstacle_threshold)
+    labels = segment_image(img, terrain_threshold, obstacle_threshold, rock_hsv_thresh)
 
-    # 3) Apply perspective transform
-    terrain_select = perspect_transform(terrain_select, source, destination)
-    rock_select = perspect_transform(rock_select, source, destination)
-    obstacle_select = perspect_transform(obstacle_select, source, destination)
+    # 3) Apply perspective transform, all label channels are warped at once
+    warped = geometry.warp(labels)
+    obstacle_select = warped[:, :, 0]
+    rock_select = warped[:, :, 1]
+    terrain_select = warped[:, :, 2]
 
     # 4) Update Rover.vision_image (this will be displayed on left side of screen)
-    Rover.vision_image[:, :, 0] = obstacle_select * 255
-    Rover.vision_image[:, :, 1] = rock_select * 255
-    Rover.vision_image[:, :, 2] = terrain_select * 255
+    np.multiply(warped, 255, out=Rover.vision_image)
 
-    # 5) Convert map image pixel values to rover-centric coords
-    xpix, ypix = rover_coords(terrain_select)
-    xobstacle, yobstacle = rover_coords(obstacle_select)
-    xrock, yrock = rover_coords(rock_select)
+    # 5) Look up rover-centric and polar coords of the selected pixels
+    xpix, ypix, nav_dists, nav_angles = geometry.lookup(terrain_select)
+    xobstacle, yobstacle, obs_dists, obs_angles = geometry.lookup(obstacle_select)
+    xrock, yrock, rock_dists, rock_angles = geometry.lookup(rock_select)
 
     # 6) Convert rover-centric pixel values to world coordinates
     scale = 10
-    world_size = Rover.worldmap.shape[0]
     xpos, ypos = Rover.pos
     obstacle_x_world, obstacle_y_world = pix_to_world(xobstacle, yobstacle, xpos, ypos,
-                                                      Rover.yaw, world_size, scale)
+                                                      Rover.yaw, scale)
     rock_x_world, rock_y_world = pix_to_world(xrock, yrock, xpos, ypos,
-                                              Rover.yaw, world_size, scale)
+                                              Rover.yaw, scale)
     navigable_x_world, navigable_y_world = pix_to_world(xpix, ypix, xpos, ypos,
-                                                        Rover.yaw, world_size, scale)
+                                                        Rover.yaw, scale)
 
-    # 7) Update Rover worldmap (to be displayed on right side of screen)
+    # 7) Find the worldmap cells to update (displayed on right side of screen)
     # mapping are valid when roll and pitch angles are near zero.
     roll_condition = [Rover.roll < 0.4, Rover.roll > 359.6]
     pitch_condition = [Rover.pitch < 0.4, Rover.pitch > 359.6]
     if any(roll_condition) and any(pitch_condition):
-        Rover.worldmap[obstacle_y_world, obstacle_x_world, 0] += 1
-        Rover.worldmap[rock_y_world, rock_x_world, 1] += 1
-        Rover.worldmap[navigable_y_world, navigable_x_world, 2] += 1
+        Rover.world_hits = world_hits(Rover.worldmap.shape,
+                                      [(obstacle_x_world, obstacle_y_world),
+                                       (rock_x_world, rock_y_world),
+                                       (navigable_x_world, navigable_y_world)])
+    else:
+        Rover.world_hits = np.array([], dtype=np.intp)
+    Rover.world_counts = count_hits(Rover.world_hits)
 
-    # 8) Convert rover-centric pixel positions to polar coordinates
-    Rover.nav_dists, Rover.nav_angles = to_polar_coords(xpix, ypix)
-    Rover.obs_dists, Rover.obs_angles = to_polar_coords(xobstacle, yobstacle)
-    Rover.rock_dists, Rover.rock_angles = to_polar_coords(xrock, yrock)
+    # 8) Update rover-centric polar coords of the selected pixels
+    Rover.nav_dists, Rover.nav_angles = nav_dists, nav_angles
+    Rover.obs_dists, Rover.obs_angles = obs_dists, obs_angles
+    Rover.rock_dists, Rover.rock_angles = rock_dists, rock_angles
 
+    # 9) Summarize them for decision_step
+    Rover.features = FrameFeatures(nav_angles, rock_angles, obstacle_select,
+                                   nav_dists if Rover.weight_angles_by_distance else None)
+
+    return Rover
+
+
+def map_frame(Rover):
+    """Add the hits of the projected frame in Rover.world_counts
+    to the worldmap and everything kept up to date from it"""
+    # Update Rover worldmap, all three layers at once
+    touched, counts = Rover.world_counts
+    add_hit_counts(Rover.worldmap, touched, counts)
+    # Keep map statistics and overlay up to date with the touched cells only
+    Rover.map_stats.update(Rover.worldmap, touched, counts)
+    Rover.rock_samples.update(Rover.worldmap, touched)
+    # Let the path planner home repair its search where the map changed
+    if Rover.planner is not None:
+        Rover.planner.update(touched)
+    # and the explorer its frontier index
+    if Rover.explorer is not None:
+        Rover.explorer.update(touched, counts)
     return Rover
+
+
+def perception_step(Rover):
+    """Perform perception steps to update Rover()"""
+    Rover = project_frame(Rover)
+    return map_frame(Rover)
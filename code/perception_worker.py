@@ -0,0 +1,179 @@
+import base64
+import multiprocessing
+import traceback
+from multiprocessing import shared_memory
+
+import numpy as np
+import eventlet
+import eventlet.hubs
+import eventlet.queue
+import eventlet.semaphore
+
+from perception import project_frame
+from supporting_functions import update_rover, decode_jpeg
+
+# Camera half of perception in a worker process. The server writes the
+# JPEG bytes of each frame into a slot of a shared memory ring, the worker
+# decodes it into the same slot and runs project_frame, and sends back the
+# worldmap entries the frame touched with the hits on each, and the
+# FrameFeatures of the frame. The decoded image, the vision image and the
+# obstacle summed-area table stay in the slot, so only small arrays go
+# through the pipe. The worldmap and everything kept from it are only
+# updated in the server process, with map_frame. A frame that fails in
+# the worker is sent back as an error with its traceback, which project()
+# raises.
+
+
+class FrameRing():
+    """Frame slots in shared memory. Each slot holds the JPEG bytes
+    of a camera frame, the decoded camera image, the vision image and
+    the obstacle summed-area table of FrameFeatures.
+    A name attaches to the ring another process created."""
+
+    def __init__(self, slots=3, image_shape=(160, 320, 3), jpeg_size=1 << 17, name=None):
+        table_shape = (image_shape[0] + 1, image_shape[1] + 1)
+        layout = [('jpegs', np.uint8, (jpeg_size,)),
+                  ('images', np.uint8, image_shape),
+                  ('visions', np.uint8, image_shape),
+                  ('tables', np.int32, table_shape)]
+        sizes = [slots * int(np.prod(shape)) * np.dtype(dtype).itemsize
+                 for _, dtype, shape in layout]
+        self.shm = shared_memory.SharedMemory(name=name, create=name is None, size=sum(sizes))
+        self.name = self.shm.name
+        self.slots = slots
+        offset = 0
+        for (field, dtype, shape), size in zip(layout, sizes):
+            setattr(self, field, np.ndarray((slots,) + tuple(shape), dtype,
+                                            buffer=self.shm.buf, offset=offset))
+            offset += size
+
+    def unlink(self):
+        """Free the shared memory once every process is done with it.
+        Rover may still hold views of the slots, so it is not closed."""
+        self.shm.unlink()
+
+
+def serve(conn, ring_name, slots, Rover):
+    """Worker process loop, project every frame sent over conn.
+    Rover is the server's RoverState at start, only its calibration
+    and the shape of its worldmap are used."""
+    ring = FrameRing(slots, name=ring_name)
+    Rover.log_every = 0
+    while True:
+        request = conn.recv()
+        if request is None:
+            break
+        slot, size, data, calibration = request
+        try:
+            conn.send((slot,) + project_slot(ring, slot, size, data, calibration, Rover))
+        except Exception:
+            # The frame is dropped, the worker goes on with the next one.
+            # The traceback is sent as text, the exception may not pickle.
+            conn.send((slot, RuntimeError('Perception worker failed on a frame\n' +
+                                          traceback.format_exc())))
+
+
+def project_slot(ring, slot, size, data, calibration, Rover):
+    """Decode and project the frame in a slot of ring.
+    Output: counted worldmap hits, FrameFeatures of the frame"""
+    (Rover.dst_size, Rover.bottom_offset, Rover.source_points,
+     Rover.weight_angles_by_distance) = calibration
+    out = ring.images[slot]
+    img = decode_jpeg(ring.jpegs[slot, :size], out)
+    if img is not out:
+        raise ValueError('Camera image of shape {} does not fit the frame ring'.format(
+            img.shape))
+    Rover.vision_image = ring.visions[slot]
+    Rover, _ = update_rover(Rover, data, (img, None))
+    Rover = project_frame(Rover)
+    # The summed-area table goes back through the ring, not the pipe
+    features = Rover.features
+    ring.tables[slot] = features.obstacle_table
+    features.obstacle_table = None
+    touched, counts = Rover.world_counts
+    return (touched.astype(np.int32), counts.astype(np.int32)), features
+
+
+class PerceptionWorker():
+    """Server side of the perception worker process.
+    project() waits for a frame without blocking other green threads,
+    frames from several green threads are projected one at a time.
+    A slot is in use from project() until the frame after it is
+    applied to the same Rover, or the Rover is released, so project()
+    waits when every slot is in use."""
+
+    def __init__(self, Rover, slots=3):
+        self.ring = FrameRing(slots)
+        self.conn, child_conn = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=serve, daemon=True,
+                                               args=(child_conn, self.ring.name, slots, Rover))
+        self.free = eventlet.queue.LightQueue()
+        for slot in range(slots):
+            self.free.put(slot)
+        self.held = {}  # id(Rover): slot of the frame applied to Rover
+        self.lock = eventlet.semaphore.Semaphore()  # Held while the worker projects a frame
+
+    def start(self):
+        self.process.start()
+
+    def project(self, data, Rover):
+        """Decode and project one telemetry frame in the worker.
+        Output: decoded image and JPEG bytes for update_rover,
+        projection for apply"""
+        jpeg = base64.b64decode(data["image"])
+        if len(jpeg) > self.ring.jpegs.shape[1]:
+            raise ValueError('JPEG frame of {} bytes does not fit the frame ring'.format(len(jpeg)))
+        if not self.process.is_alive():
+            raise RuntimeError('Perception worker process exited with code {}'.format(
+                self.process.exitcode))
+        slot = self.free.get()
+        try:
+            self.ring.jpegs[slot, :len(jpeg)] = np.frombuffer(jpeg, dtype=np.uint8)
+            telemetry = {key: value for key, value in data.items() if key != 'image'}
+            calibration = (Rover.dst_size, Rover.bottom_offset, Rover.source_points,
+                           Rover.weight_angles_by_distance)
+            with self.lock:
+                self.conn.send((slot, len(jpeg), telemetry, calibration))
+                eventlet.hubs.trampoline(self.conn.fileno(), read=True)
+                projection = self.conn.recv()
+        except BaseException:
+            # Also when the worker died mid frame (EOFError)
+            self.free.put(slot)
+            raise
+        if isinstance(projection[1], Exception):
+            self.free.put(slot)
+            raise projection[1]
+        return (self.ring.images[slot], jpeg), projection
+
+    def apply(self, Rover, projection):
+        """Set the results of a projected frame on Rover, as project_frame
+        would have. world_hits and the pixel polar coords (nav_angles,
+        obs_dists...) are not sent back and stay None."""
+        slot, world_counts, features = projection
+        features.obstacle_table = self.ring.tables[slot]
+        Rover.world_hits = None
+        Rover.world_counts = world_counts
+        Rover.features = features
+        Rover.vision_image = self.ring.visions[slot]
+        # Rover no longer refers to the previous frame's slot
+        self.release(Rover)
+        self.held[id(Rover)] = slot
+        return Rover
+
+    def release(self, Rover):
+        """Free the slot Rover refers to, when it is done with"""
+        slot = self.held.pop(id(Rover), None)
+        if slot is not None:
+            self.free.put(slot)
+
+    def discard(self, projection):
+        """Free the slot of a projection that failed before it was applied"""
+        slot = projection[0]
+        if slot not in self.held.values():
+            self.free.put(slot)
+
+    def close(self):
+        if self.process.is_alive():
+            self.conn.send(None)
+            self.process.join(timeout=1)
+        self.ring.unlink()
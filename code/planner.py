@@ -0,0 +1,380 @@
+import heapq
+import math
+
+import numpy as np
+
+from worldmap import cell_values, worldmap_blocks
+
+# Path planning over the worldmap, for the return to the start point
+# and for exploration. Cells are classed from their obstacle and
+# navigable hit counts and searched with D* Lite: the search runs from
+# the goal to the rover, so when the rover moves or the map changes only
+# the affected part of the search is repaired instead of planning again
+# from scratch. Exploration heads for frontier cells, the mapped
+# navigable cells next to cells without any hits yet.
+
+# Costs of entering a cell of each class
+NAVIGABLE_COST = 1.0
+UNKNOWN_COST = 4.0
+OBSTACLE_COST = math.inf
+
+# Cells of the worldmap are classed in square chunks of this many cells a side
+CHUNK_SIZE = 16
+
+# 8-connected grid moves as (dy, dx, length)
+MOVES = [(dy, dx, math.hypot(dy, dx)) for dy in (-1, 0, 1) for dx in (-1, 0, 1)
+         if dy or dx]
+
+
+def cell_costs(nav_counts, obs_counts):
+    """Entering cost of cells from their navigable and obstacle hit counts.
+    Cells seen navigable are, as in clean_obstacles, even with obstacle
+    hits. Cells with only obstacle hits are blocked, and cells without
+    any hits are unknown and cost more than navigable ones."""
+    costs = np.full(nav_counts.shape, UNKNOWN_COST)
+    costs[obs_counts > 0] = OBSTACLE_COST
+    costs[nav_counts > 0] = NAVIGABLE_COST
+    return costs
+
+
+class CostGrid():
+    """Entering costs of the worldmap cells for path searches.
+    Costs are read from the worldmap on first use and kept in chunks,
+    update() refreshes the loaded ones from each frame's touched entries."""
+
+    def __init__(self, worldmap):
+        self.worldmap = worldmap
+        self.rows, self.cols = worldmap.shape[:2]
+        self.chunks = {}  # (chunk row, chunk col): entering costs of the chunk cells
+
+    def cell(self, pos):
+        """Worldmap (row, col) of an (x, y) position"""
+        return (min(max(int(pos[1]), 0), self.rows - 1),
+                min(max(int(pos[0]), 0), self.cols - 1))
+
+    def load_chunk(self, chunk):
+        """Read the costs of one chunk from the worldmap"""
+        row, col = chunk[0] * CHUNK_SIZE, chunk[1] * CHUNK_SIZE
+        ypos, xpos = np.mgrid[row:min(row + CHUNK_SIZE, self.rows),
+                              col:min(col + CHUNK_SIZE, self.cols)]
+        flat = (ypos * self.cols + xpos) * self.worldmap.shape[2]
+        costs = cell_costs(cell_values(self.worldmap, flat.ravel() + 2),
+                           cell_values(self.worldmap, flat.ravel()))
+        # Nested lists, element access is faster than on an array
+        self.chunks[chunk] = costs = costs.reshape(ypos.shape).tolist()
+        return costs
+
+    def cost(self, cell):
+        chunk = (cell[0] // CHUNK_SIZE, cell[1] // CHUNK_SIZE)
+        costs = self.chunks.get(chunk)
+        if costs is None:
+            costs = self.load_chunk(chunk)
+        return costs[cell[0] % CHUNK_SIZE][cell[1] % CHUNK_SIZE]
+
+    def update(self, touched):
+        """Refresh the loaded costs at the worldmap entries touched by a frame in map_frame.
+        Output: set of the cells whose cost changed"""
+        changed = set()
+        if len(touched) == 0:
+            return changed
+        depth = self.worldmap.shape[2]
+        cells = np.unique(touched // depth)
+        ypos, xpos = np.divmod(cells, self.cols)
+        chunk_rows, chunk_cols = ypos // CHUNK_SIZE, xpos // CHUNK_SIZE
+        loaded = np.array([(chunk_row, chunk_col) in self.chunks
+                           for chunk_row, chunk_col in zip(chunk_rows.tolist(), chunk_cols.tolist())],
+                          dtype=bool)
+        if not loaded.any():
+            return changed
+        cells, ypos, xpos = cells[loaded], ypos[loaded], xpos[loaded]
+        costs = cell_costs(cell_values(self.worldmap, cells * depth + 2),
+                           cell_values(self.worldmap, cells * depth))
+        for y, x, cost in zip(ypos.tolist(), xpos.tolist(), costs.tolist()):
+            chunk_row = self.chunks[(y // CHUNK_SIZE, x // CHUNK_SIZE)][y % CHUNK_SIZE]
+            if chunk_row[x % CHUNK_SIZE] != cost:
+                chunk_row[x % CHUNK_SIZE] = cost
+                changed.add((y, x))
+        return changed
+
+    def neighbors(self, cell):
+        y, x = cell
+        for dy, dx, length in MOVES:
+            if 0 <= y + dy < self.rows and 0 <= x + dx < self.cols:
+                yield (y + dy, x + dx), length
+
+
+def octile(cell_1, cell_2):
+    """Octile distance between cells, a lower bound of the path cost"""
+    dy, dx = abs(cell_1[0] - cell_2[0]), abs(cell_1[1] - cell_2[1])
+    return max(dy, dx) + (math.sqrt(2) - 1) * min(dy, dx)
+
+
+class GridPlanner():
+    """D* Lite planner from the rover to a fixed goal on the worldmap.
+    update() checks the entries each frame touches against the cell
+    costs, and plan() repairs the search for the cells that changed
+    class and for the distance the rover moved. A CostGrid can be
+    shared with other searches over the same worldmap."""
+
+    def __init__(self, worldmap, goal, costs=None):
+        self.costs = costs if costs is not None else CostGrid(worldmap)
+        self.goal = self.costs.cell(goal)
+        self.changed = set()  # Cells whose cost changed since the last plan
+        self.g = {}
+        self.rhs = {self.goal: 0.0}
+        self.open = {}  # Cell: its key in the queue
+        self.queue = []
+        self.km = 0.0
+        self.last = None  # Rover cell of the last plan
+        self.start = None  # Rover cell
+        self.push(self.goal)
+
+    def cost(self, cell):
+        if cell == self.goal:
+            return NAVIGABLE_COST
+        return self.costs.cost(cell)
+
+    def update(self, touched):
+        """Check the worldmap entries touched by a frame in map_frame
+        for cells that changed class"""
+        self.changed.update(self.costs.update(touched))
+
+    def neighbors(self, cell):
+        return self.costs.neighbors(cell)
+
+    def heuristic(self, cell):
+        return octile(cell, self.start)
+
+    def key(self, cell):
+        best = min(self.g.get(cell, math.inf), self.rhs.get(cell, math.inf))
+        return (best + self.heuristic(cell) + self.km, best)
+
+    def push(self, cell):
+        key = self.key(cell) if self.start is not None else (0.0, 0.0)
+        self.open[cell] = key
+        heapq.heappush(self.queue, (key, cell))
+
+    def requeue(self, cell):
+        """Queue a cell if it is inconsistent, take it off the queue if not"""
+        self.open.pop(cell, None)
+        if self.g.get(cell, math.inf) != self.rhs.get(cell, math.inf):
+            self.push(cell)
+
+    def update_vertex(self, cell):
+        if cell != self.goal:
+            self.rhs[cell] = min((length * self.cost(neighbor) + self.g.get(neighbor, math.inf)
+                                  for neighbor, length in self.neighbors(cell)), default=math.inf)
+        self.requeue(cell)
+
+    def compute(self, max_expansions):
+        """Expand cells until the rover cell is consistent.
+        Output: False if max_expansions ran out first"""
+        for _ in range(max_expansions):
+            # Drop queue entries superseded by a later push
+            while self.queue and self.open.get(self.queue[0][1]) != self.queue[0][0]:
+                heapq.heappop(self.queue)
+            start_key = self.key(self.start)
+            if not self.queue or (self.queue[0][0] >= start_key and
+                                  self.rhs.get(self.start, math.inf) <= self.g.get(self.start, math.inf)):
+                return True
+            old_key, cell = heapq.heappop(self.queue)
+            del self.open[cell]
+            new_key = self.key(cell)
+            if old_key < new_key:
+                self.push(cell)
+            elif self.g.get(cell, math.inf) > self.rhs.get(cell, math.inf):
+                # Cheaper path to cell: only the neighbors' path through it can improve
+                self.g[cell] = g = self.rhs[cell]
+                cost = self.cost(cell)
+                for neighbor, length in self.neighbors(cell):
+                    if neighbor != self.goal and length * cost + g < self.rhs.get(neighbor, math.inf):
+                        self.rhs[neighbor] = length * cost + g
+                        self.requeue(neighbor)
+            else:
+                self.g[cell] = math.inf
+                self.update_vertex(cell)
+                for neighbor, _ in self.neighbors(cell):
+                    self.update_vertex(neighbor)
+        return False
+
+    def plan(self, pos, max_expansions=500, max_waypoints=20):
+        """Waypoints (x, y) of the path from pos toward the goal, at cell centers.
+        It runs in decision_step, so each call expands at most max_expansions
+        cells (about 5 ms) and the search is resumed on the next call.
+        Output: list of waypoints, None while there is no path yet"""
+        start = self.costs.cell(pos)
+        if self.start is None:
+            self.start = self.last = start
+            # The goal was queued before there was a rover cell for its key
+            self.open.clear()
+            self.queue = []
+            self.push(self.goal)
+        elif start != self.start:
+            self.start = start
+            self.km += self.heuristic(self.last)
+            self.last = start
+        # Moves into or out of a changed cell cost differently now. The cells
+        # to recheck count against max_expansions too, what is left of them
+        # is rechecked on the next call
+        affected = set()
+        while self.changed and len(affected) < max_expansions:
+            cell = self.changed.pop()
+            affected.add(cell)
+            affected.update(neighbor for neighbor, _ in self.neighbors(cell))
+        for cell in affected:
+            self.update_vertex(cell)
+        if (not self.compute(max(max_expansions - len(affected), 0)) or self.changed or
+                self.rhs.get(self.start, math.inf) == math.inf):
+            return None
+        # Follow the cheapest successors from the rover cell
+        waypoints = []
+        cell = self.start
+        while cell != self.goal and len(waypoints) < max_waypoints:
+            cell = min(self.neighbors(cell),
+                       key=lambda item: item[1] * self.cost(item[0]) + self.g.get(item[0], math.inf))[0]
+            waypoints.append((cell[1] + 0.5, cell[0] + 0.5))
+        return waypoints
+
+
+class FrontierIndex():
+    """Frontier cells of the worldmap: cells seen navigable next to cells
+    without any hits. A cell only changes frontier status when it or a
+    neighbor is mapped for the first time, so each frame only rechecks
+    around the entries that were empty before it."""
+
+    def __init__(self, worldmap):
+        self.worldmap = worldmap
+        self.rows, self.cols, self.depth = worldmap.shape
+        self.cells = set()  # Flat cell indices of the frontier cells
+        # Take in what is mapped already
+        for row, col, block in worldmap_blocks(worldmap):
+            ypos, xpos = (block[:, :, 2] > 0).nonzero()
+            inside = (ypos + row < self.rows) & (xpos + col < self.cols)
+            self.refresh((ypos[inside] + row) * self.cols + xpos[inside] + col)
+
+    def around(self, cells):
+        """Cells and their neighbors inside the worldmap"""
+        ypos, xpos = np.divmod(cells, self.cols)
+        around = [cells]
+        for dy, dx, _ in MOVES:
+            inside = ((ypos + dy >= 0) & (ypos + dy < self.rows) &
+                      (xpos + dx >= 0) & (xpos + dx < self.cols))
+            around.append((ypos[inside] + dy) * self.cols + xpos[inside] + dx)
+        return np.unique(np.concatenate(around))
+
+    def refresh(self, cells):
+        """Recompute whether cells are frontier cells"""
+        if len(cells) == 0:
+            return
+        ypos, xpos = np.divmod(cells, self.cols)
+        unknown_neighbor = np.zeros(len(cells), dtype=bool)
+        for dy, dx, _ in MOVES:
+            inside = ((ypos + dy >= 0) & (ypos + dy < self.rows) &
+                      (xpos + dx >= 0) & (xpos + dx < self.cols))
+            neighbors = ((ypos[inside] + dy) * self.cols + xpos[inside] + dx) * self.depth
+            unknown_neighbor[inside] |= ((cell_values(self.worldmap, neighbors + 2) == 0) &
+                                         (cell_values(self.worldmap, neighbors) == 0))
+        frontier = unknown_neighbor & (cell_values(self.worldmap, cells * self.depth + 2) > 0)
+        self.cells.difference_update(cells[~frontier].tolist())
+        self.cells.update(cells[frontier].tolist())
+
+    def update(self, touched, counts):
+        """Update with the worldmap entries touched by a frame in map_frame"""
+        layer = touched % self.depth
+        # Entries holding exactly what was just added were empty before
+        new = (cell_values(self.worldmap, touched) == counts) & (layer != 1)
+        if new.any():
+            self.refresh(self.around(np.unique(touched[new] // self.depth)))
+
+
+class Explorer():
+    """Exploration targets: the frontier cell with the lowest travel
+    cost from the rover, reached along a GridPlanner path. A target is
+    dropped when the rover gets within reach cells of it, when it stops
+    being a frontier cell or after timeout seconds, and is not picked
+    again. When no target is found the search waits retry seconds.
+    The target search expands at most step_expansions cells a call,
+    and max_expansions cells in all, so it is spread over frames."""
+
+    def __init__(self, worldmap, reach=3, timeout=30, retry=5, max_expansions=20000,
+                 step_expansions=300):
+        self.worldmap = worldmap
+        self.reach = reach
+        self.timeout = timeout
+        self.retry = retry
+        self.retry_time = None  # Time of the next search after a failed one
+        self.max_expansions = max_expansions
+        self.step_expansions = step_expansions
+        self.search = None  # (start, dist, queue, expansions) of the target search going on
+        self.costs = CostGrid(worldmap)
+        self.frontier = FrontierIndex(worldmap)
+        self.visited = set()  # Flat cell indices of the dropped targets
+        self.goal = None  # Target cell
+        self.goal_time = None  # Time the target was picked
+        self.planner = None
+
+    def update(self, touched, counts):
+        """Update with the worldmap entries touched by a frame in map_frame"""
+        self.frontier.update(touched, counts)
+        changed = self.costs.update(touched)
+        if self.planner is not None:
+            self.planner.changed.update(changed)
+
+    def flat(self, cell):
+        return cell[0] * self.costs.cols + cell[1]
+
+    def nearest(self, start):
+        """Frontier cell with the lowest travel cost from start, not nearer than reach.
+        A search started on an earlier call goes on from its own start cell.
+        Output: (done, cell), cell is None if no frontier cell is left
+        in max_expansions"""
+        if self.search is None:
+            if not self.frontier.cells - self.visited:
+                return True, None
+            self.search = (start, {start: 0.0}, [(0.0, start)], 0)
+        start, dist, queue, expansions = self.search
+        for _ in range(self.step_expansions):
+            if not queue or expansions >= self.max_expansions:
+                self.search = None
+                return True, None
+            expansions += 1
+            cost, cell = heapq.heappop(queue)
+            if cost > dist[cell]:
+                continue
+            flat = self.flat(cell)
+            if (flat in self.frontier.cells and flat not in self.visited and
+                    octile(cell, start) > self.reach):
+                self.search = None
+                return True, cell
+            for neighbor, length in self.costs.neighbors(cell):
+                new_cost = cost + length * self.costs.cost(neighbor)
+                if new_cost < dist.get(neighbor, math.inf):
+                    dist[neighbor] = new_cost
+                    heapq.heappush(queue, (new_cost, neighbor))
+        self.search = (start, dist, queue, expansions)
+        return False, None
+
+    def waypoints(self, pos, now):
+        """Waypoints (x, y) toward the current target, picking a new
+        target when needed. Output: None while a target is searched
+        for and when no frontier is left"""
+        start = self.costs.cell(pos)
+        if self.goal is not None and (octile(start, self.goal) <= self.reach or
+                                      self.flat(self.goal) not in self.frontier.cells or
+                                      now - self.goal_time > self.timeout):
+            self.visited.add(self.flat(self.goal))
+            self.goal = None
+        if self.goal is None:
+            if self.retry_time is not None and now < self.retry_time:
+                return None
+            done, self.goal = self.nearest(start)
+            if not done:
+                return None
+            if self.goal is None:
+                self.retry_time = now + self.retry
+                return None
+            self.goal_time = now
+            self.planner = GridPlanner(self.worldmap, (self.goal[1] + 0.5, self.goal[0] + 0.5),
+                                       self.costs)
+        # Head straight for the target while its path is still being searched
+        return self.planner.plan(pos) or [(self.goal[1] + 0.5, self.goal[0] + 0.5)]
@@ -0,0 +1,154 @@
+# Record telemetry frames into a segmented archive without blocking the control loop
+# Extract an archive to IMG/ + robot_log.csv: $ python recorder.py archive_folder output_folder
+import argparse
+import csv
+import os
+import queue
+import threading
+from datetime import datetime
+
+# Columns of robot_log.csv, followed by where each frame is stored in the archive
+INDEX_COLUMNS = ['Path', 'SteerAngle', 'Throttle', 'Brake', 'Speed',
+                 'X_Position', 'Y_Position', 'Pitch', 'Yaw', 'Roll',
+                 'Segment', 'Offset', 'Length']
+INDEX_FILE = 'robot_log.csv'
+
+
+class TelemetryRecorder():
+    """Record telemetry frames from a background thread.
+    The original JPEG bytes are appended to segment files, written in
+    chunks of chunk_size bytes, and a new segment is started after
+    segment_size bytes. robot_log.csv is the index: the usual columns,
+    then the segment, offset and length of each frame. Frames are
+    dropped and counted when more than max_pending are waiting."""
+
+    def __init__(self, folder, segment_size=256 * 2**20, chunk_size=4 * 2**20, max_pending=256):
+        self.folder = folder
+        self.segment_size = segment_size
+        self.chunk_size = chunk_size
+        self.pending = queue.Queue(max_pending)
+        self.recorded = 0  # Frames written to the archive
+        self.dropped = 0  # Frames dropped because the writer fell behind
+        self.segment = -1
+        self.segment_file = None
+        self.offset = 0
+        self.chunk = []  # JPEG bytes not written yet
+        self.chunk_bytes = 0
+        self.rows = []  # Index rows of the frames in chunk
+        self.index_file = open(os.path.join(folder, INDEX_FILE), 'w', newline='')
+        self.index = csv.writer(self.index_file, delimiter=';')
+        self.index.writerow(INDEX_COLUMNS)
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def record(self, data, jpeg):
+        """Queue one telemetry frame, never blocks.
+        Output: False if the frame was dropped"""
+        timestamp = datetime.utcnow().strftime('%Y_%m_%d_%H_%M_%S_%f')[:-3]
+        try:
+            self.pending.put_nowait((timestamp, data, jpeg))
+        except queue.Full:
+            self.dropped += 1
+            return False
+        return True
+
+    def close(self):
+        """Write the frames still waiting and close the archive"""
+        self.pending.put(None)
+        self.thread.join()
+        print("Recorded {} frames into {}, dropped {}".format(
+            self.recorded, self.folder, self.dropped))
+
+    def run(self):
+        while True:
+            item = self.pending.get()
+            if item is None:
+                break
+            self.append(*item)
+        self.flush()
+        if self.segment_file is not None:
+            self.segment_file.close()
+        self.index_file.close()
+
+    def append(self, timestamp, data, jpeg):
+        if self.segment_file is None or self.offset + self.chunk_bytes >= self.segment_size:
+            self.next_segment()
+        x_position, y_position = data["position"].split(';')
+        self.rows.append(['IMG/robocam_{}.jpg'.format(timestamp),
+                          data["steering_angle"], data["throttle"], data.get("brake", '0'),
+                          data["speed"], x_position.strip(), y_position.strip(),
+                          data["pitch"], data["yaw"], data["roll"],
+                          self.segment, self.offset + self.chunk_bytes, len(jpeg)])
+        self.chunk.append(jpeg)
+        self.chunk_bytes += len(jpeg)
+        if self.chunk_bytes >= self.chunk_size:
+            self.flush()
+
+    def next_segment(self):
+        self.flush()
+        if self.segment_file is not None:
+            self.segment_file.close()
+        self.segment += 1
+        self.offset = 0
+        self.segment_file = open(segment_path(self.folder, self.segment), 'wb')
+
+    def flush(self):
+        """Write the buffered chunk, then its index rows"""
+        if not self.chunk:
+            return
+        self.segment_file.write(b''.join(self.chunk))
+        self.segment_file.flush()
+        os.fsync(self.segment_file.fileno())
+        # Index rows only point at bytes already on disk
+        self.index.writerows(self.rows)
+        self.index_file.flush()
+        self.offset += self.chunk_bytes
+        self.recorded += len(self.rows)
+        self.chunk = []
+        self.chunk_bytes = 0
+        self.rows = []
+
+
+def segment_path(folder, segment):
+    return os.path.join(folder, 'segment_{:05d}.bin'.format(int(segment)))
+
+
+def read_frame(folder, segment, offset, length):
+    """Read the JPEG bytes of one archived frame"""
+    with open(segment_path(folder, segment), 'rb') as f:
+        f.seek(int(offset))
+        return f.read(int(length))
+
+
+def extract_archive(folder, output_folder):
+    """Write an archive out as IMG/*.jpg and a plain robot_log.csv"""
+    os.makedirs(os.path.join(output_folder, 'IMG'), exist_ok=True)
+    with open(os.path.join(folder, INDEX_FILE)) as f_in, \
+            open(os.path.join(output_folder, INDEX_FILE), 'w', newline='') as f_out:
+        log = csv.writer(f_out, delimiter=';')
+        log.writerow(INDEX_COLUMNS[:-3])
+        count = 0
+        for row in csv.DictReader(f_in, delimiter=';'):
+            jpeg = read_frame(folder, row['Segment'], row['Offset'], row['Length'])
+            with open(os.path.join(output_folder, row['Path']), 'wb') as f:
+                f.write(jpeg)
+            log.writerow([row[column] for column in INDEX_COLUMNS[:-3]])
+            count += 1
+    return count
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Extract a recorded telemetry archive')
+    parser.add_argument(
+        'archive_folder',
+        type=str,
+        help='Folder of the recorded archive.'
+    )
+    parser.add_argument(
+        'output_folder',
+        type=str,
+        help='Folder to write IMG/ and robot_log.csv to.'
+    )
+    args = parser.parse_args()
+    count = extract_archive(args.archive_folder, args.output_folder)
+    print("Extracted {} frames to {}".format(count, args.output_folder))
@@ -0,0 +1,178 @@
+# Replay a recorded dataset through perception and mapping without the simulator
+# Example: $ python replay.py ../test_dataset/robot_log.csv --workers 4 --output replay_map.jpg
+import argparse
+import base64
+import csv
+import os
+import time
+from datetime import datetime
+from multiprocessing import Pool, cpu_count
+
+import numpy as np
+from PIL import Image
+
+from drive_rover import RoverState
+from recorder import read_frame
+from perception import project_frame, map_frame
+from supporting_functions import convert_to_float, create_map_image, decode_jpeg
+
+
+def frame_timestamp(path):
+    """Parse the recording time from an image name like
+    robocam_2017_05_02_11_16_21_421.jpg, in seconds"""
+    stamp = os.path.splitext(os.path.basename(path))[0].split('_', 1)[1]
+    return datetime.strptime(stamp, '%Y_%m_%d_%H_%M_%S_%f').timestamp()
+
+
+def read_robot_log(csv_path):
+    """Read a robot_log.csv recording into a list of frame dicts.
+    Image paths are tried as written first, then next to the csv in IMG/.
+    The robot_log.csv of a recorder.py archive is read as well."""
+    csv_dir = os.path.dirname(os.path.abspath(csv_path))
+    frames = []
+    with open(csv_path) as f:
+        for row in csv.DictReader(f, delimiter=';'):
+            path = row['Path']
+            if 'Segment' in row:
+                # Frame stored in an archive segment
+                archive = (csv_dir, row['Segment'], row['Offset'], row['Length'])
+            else:
+                archive = None
+                if not os.path.exists(path):
+                    path = os.path.join(csv_dir, 'IMG', os.path.basename(path))
+            frames.append({
+                'archive': archive,
+                'path': path,
+                'steer': convert_to_float(row['SteerAngle']),
+                'throttle': convert_to_float(row['Throttle']),
+                'brake': convert_to_float(row['Brake']),
+                'speed': convert_to_float(row['Speed']),
+                'pos': (convert_to_float(row['X_Position']), convert_to_float(row['Y_Position'])),
+                'pitch': convert_to_float(row['Pitch']),
+                'yaw': convert_to_float(row['Yaw']),
+                'roll': convert_to_float(row['Roll']),
+            })
+    return frames
+
+
+def frame_jpeg(frame):
+    """JPEG bytes of a recorded frame"""
+    if frame['archive'] is not None:
+        return read_frame(*frame['archive'])
+    with open(frame['path'], 'rb') as f:
+        return f.read()
+
+
+def make_telemetry(frame):
+    """Build a simulator telemetry message from a recorded frame.
+    Sample positions are not recorded, so none are sent."""
+    image_string = base64.b64encode(frame_jpeg(frame)).decode("utf-8")
+    return {
+        'speed': str(frame['speed']),
+        'position': '{};{}'.format(*frame['pos']),
+        'yaw': str(frame['yaw']),
+        'pitch': str(frame['pitch']),
+        'roll': str(frame['roll']),
+        'throttle': str(frame['throttle']),
+        'steering_angle': str(frame['steer']),
+        'brake': str(frame['brake']),
+        'near_sample': '0',
+        'picking_up': '0',
+        'sample_count': '0',
+        'samples_x': '',
+        'samples_y': '',
+        'image': image_string,
+    }
+
+
+# Rover state of each worker process
+_worker_rover = None
+
+
+def _init_worker():
+    global _worker_rover
+    _worker_rover = RoverState()
+
+
+def _project(frame):
+    """Decode one frame and project it into worldmap indices
+    touched by it, and the hits on each"""
+    Rover = _worker_rover
+    Rover.img = decode_jpeg(frame_jpeg(frame), Rover.img)
+    Rover.pos = frame['pos']
+    Rover.yaw = frame['yaw']
+    Rover.pitch = frame['pitch']
+    Rover.roll = frame['roll']
+    Rover = project_frame(Rover)
+    touched, counts = Rover.world_counts
+    return touched.astype(np.int32), counts.astype(np.int32)
+
+
+def replay(frames, workers=None, chunksize=8):
+    """Replay frames and accumulate the worldmap in frame order.
+    Output: Rover with the final worldmap, elapsed seconds"""
+    Rover = RoverState()
+    start = time.time()
+    if workers == 1:
+        _init_worker()
+        for frame in frames:
+            Rover.world_counts = _project(frame)
+            Rover = map_frame(Rover)
+    else:
+        with Pool(workers, initializer=_init_worker) as pool:
+            # imap keeps frame order, so the reduction is the same as a serial run
+            for world_counts in pool.imap(_project, frames, chunksize):
+                Rover.world_counts = world_counts
+                Rover = map_frame(Rover)
+    elapsed = time.time() - start
+    return Rover, elapsed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Offline replay of a recorded run')
+    parser.add_argument(
+        'csv_path',
+        type=str,
+        nargs='?',
+        default='../test_dataset/robot_log.csv',
+        help='Path to the robot_log.csv of the recording.'
+    )
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=cpu_count(),
+        help='Number of worker processes, 1 replays in this process.'
+    )
+    parser.add_argument(
+        '--chunksize',
+        type=int,
+        default=8,
+        help='Frames handed to a worker at a time.'
+    )
+    parser.add_argument(
+        '--output',
+        type=str,
+        default='',
+        help='Path to save the final worldmap image.'
+    )
+    args = parser.parse_args()
+
+    frames = read_robot_log(args.csv_path)
+    if not frames:
+        parser.error('{} has no frames to replay'.format(args.csv_path))
+    Rover, elapsed = replay(frames, args.workers, args.chunksize)
+
+    # Recording duration, to compare the replay speed with real time
+    duration = frame_timestamp(frames[-1]['path']) - frame_timestamp(frames[0]['path'])
+    perc_mapped, fidelity = Rover.map_stats.perc_mapped, Rover.map_stats.fidelity
+    fps = len(frames) / elapsed
+    print("Replayed {} frames in {:.2f} s ({:.1f} FPS, {:.1f}x real time)".format(
+        len(frames), elapsed, fps, duration / elapsed))
+    print("Mapped: {}%  Fidelity: {}%".format(perc_mapped, fidelity))
+
+    if args.output != '':
+        Rover.total_time = duration
+        Rover.samples_pos = (np.array([], dtype=int), np.array([], dtype=int))
+        map_add = create_map_image(Rover)
+        Image.fromarray(map_add.astype(np.uint8)).save(args.output)
+        print("Saved worldmap to {}".format(args.output))
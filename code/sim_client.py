@@ -0,0 +1,134 @@
+# Stand-in for the simulator: replay a recording into drive_rover.py as telemetry events
+# Start the server first ($ python drive_rover.py), then
+# Example: $ python sim_client.py ../test_dataset/robot_log.csv --rate 100 --loops 5
+import argparse
+import json
+import time
+
+import numpy as np
+import socketio
+
+from replay import read_robot_log, make_telemetry
+
+
+class SimClient():
+    """socketio client that sends telemetry and times the replies.
+    Every telemetry message carries a frame_id that drive_rover.py
+    echoes in its 'data' reply, so round trips are matched even when
+    the server drops superseded frames."""
+
+    def __init__(self):
+        self.sio = socketio.Client()
+        self.sent = {}  # frame_id: send time of frames without a reply yet
+        self.round_trips = []  # Round trip seconds of answered frames
+        self.replies = 0
+        self.pickups = 0
+        self.sio.on('data', self.on_data)
+        self.sio.on('pickup', self.on_pickup)
+
+    def on_data(self, data):
+        sent = self.sent.pop(data.get('frame_id'), None)
+        if sent is not None:
+            self.round_trips.append(time.perf_counter() - sent)
+            self.replies += 1
+
+    def on_pickup(self, data):
+        self.pickups += 1
+
+    def send(self, frame_id, message):
+        message['frame_id'] = frame_id
+        self.sent[frame_id] = time.perf_counter()
+        self.sio.emit('telemetry', message)
+
+    def run(self, messages, rate, loops):
+        """Send every message loops times at rate frames per second,
+        0 sends as fast as possible. Output: seconds spent sending"""
+        start = time.perf_counter()
+        frame_id = 0
+        for _ in range(loops):
+            for message in messages:
+                if rate > 0:
+                    delay = start + frame_id / rate - time.perf_counter()
+                    if delay > 0:
+                        time.sleep(delay)
+                self.send(frame_id, dict(message))
+                frame_id += 1
+        return time.perf_counter() - start
+
+
+def summarize(client, sent, elapsed):
+    """Round trip percentiles and throughput of a run"""
+    round_trips = np.array(client.round_trips) * 1000
+    summary = {
+        'sent': sent,
+        'replies': client.replies,
+        'unanswered': sent - client.replies,
+        'pickups': client.pickups,
+        'send_fps': sent / elapsed,
+        'reply_fps': client.replies / elapsed,
+    }
+    if len(round_trips):
+        summary.update({
+            'rtt_p50_ms': np.percentile(round_trips, 50),
+            'rtt_p95_ms': np.percentile(round_trips, 95),
+            'rtt_p99_ms': np.percentile(round_trips, 99),
+            'rtt_max_ms': np.max(round_trips),
+        })
+    return {key: round(float(value), 3) for key, value in summary.items()}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Simulator stand-in for load testing')
+    parser.add_argument(
+        'csv_path',
+        type=str,
+        nargs='?',
+        default='../test_dataset/robot_log.csv',
+        help='Path to the robot_log.csv of the recording to replay.'
+    )
+    parser.add_argument(
+        '--url',
+        type=str,
+        default='http://localhost:4567',
+        help='Address of the drive_rover.py server.'
+    )
+    parser.add_argument(
+        '--rate',
+        type=float,
+        default=25,
+        help='Telemetry frames per second, 0 sends as fast as possible.'
+    )
+    parser.add_argument(
+        '--loops',
+        type=int,
+        default=1,
+        help='Number of times the recording is replayed.'
+    )
+    parser.add_argument(
+        '--drain',
+        type=float,
+        default=1,
+        help='Seconds to wait for the last replies.'
+    )
+    parser.add_argument(
+        '--output',
+        type=str,
+        default='',
+        help='Path to save the results as json.'
+    )
+    args = parser.parse_args()
+
+    # Messages are built up front so file reads do not slow the sender
+    messages = [make_telemetry(frame) for frame in read_robot_log(args.csv_path)]
+    client = SimClient()
+    client.sio.connect(args.url)
+    elapsed = client.run(messages, args.rate, args.loops)
+    time.sleep(args.drain)
+    client.sio.disconnect()
+
+    summary = summarize(client, len(messages) * args.loops, elapsed)
+    for key, value in summary.items():
+        print('{:<12} {}'.format(key, value))
+    if args.output != '':
+        with open(args.output, 'w') as f:
+            json.dump(summary, f, indent=2)
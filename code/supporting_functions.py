@@ -5,35 +5,82 @@ from io import BytesIO, StringIO
 import base64
 import time
 
+
+class RealClock():
+    """Wall clock, the default clock of RoverState"""
+
+    def time(self):
+        return time.time()
+
+
+class SimClock():
+    """Simulated clock for replays and simulations.
+    Time only moves when it is set or advanced, so decision
+    logic runs at full speed and behaves deterministically."""
+
+    def __init__(self, now=0.0):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+    def set(self, now):
+        self.now = now
+
+    def advance(self, seconds):
+        self.now += seconds
+
 # Define a function to convert telemetry strings to float independent of decimal convention
 
 
 def convert_to_float(string_to_convert):
     if ',' in string_to_convert:
-        float_value = np.float(string_to_convert.replace(',', '.'))
+        float_value = float(string_to_convert.replace(',', '.'))
     else:
-        float_value = np.float(string_to_convert)
+        float_value = float(string_to_convert)
     return float_value
 
 
-def update_rover(Rover, data):
+def decode_jpeg(jpeg, out=None):
+    """Decode JPEG bytes straight into an RGB array.
+    The array is copied into out when it has the right shape,
+    so one frame buffer can be reused for every frame."""
+    rgb = cv2.imdecode(np.frombuffer(jpeg, dtype=np.uint8), cv2.IMREAD_COLOR_RGB)
+    if rgb is None:
+        raise ValueError('Camera image of {} bytes is not a JPEG image'.format(len(jpeg)))
+    if out is None or out.shape != rgb.shape or not out.flags.writeable:
+        return rgb
+    np.copyto(out, rgb)
+    return out
+
+
+def decode_image(image_string, out=None):
+    """Decode a base64 JPEG camera image, see decode_jpeg.
+    Output: RGB image, JPEG bytes"""
+    jpeg = base64.b64decode(image_string)
+    return decode_jpeg(jpeg, out), jpeg
+
+
+def update_rover(Rover, data, decoded=None):
+    """Update Rover with one telemetry frame.
+    decoded is the output of decode_image when the
+    camera image was decoded already."""
     # Initialize start time and sample positions
     if Rover.start_time == None:
-        Rover.start_time = time.time()
+        Rover.start_time = Rover.clock.time()
         Rover.total_time = 0
+        # Recorded telemetry may come without sample positions
         samples_xpos = np.int_([convert_to_float(pos.strip())
-                                for pos in data["samples_x"].split(';')])
+                                for pos in data["samples_x"].split(';') if pos.strip()])
         samples_ypos = np.int_([convert_to_float(pos.strip())
-                                for pos in data["samples_y"].split(';')])
+                                for pos in data["samples_y"].split(';') if pos.strip()])
         Rover.samples_pos = (samples_xpos, samples_ypos)
-        Rover.samples_to_find = np.int(data["sample_count"])
+        Rover.samples_to_find = int(data["sample_count"])
     # Or just update elapsed time
     else:
-        tot_time = time.time() - Rover.start_time
+        tot_time = Rover.clock.time() - Rover.start_time
         if np.isfinite(tot_time):
             Rover.total_time = tot_time
-    # Print out the fields in the telemetry data dictionary
-    print(data.keys())
     # The current speed of the rover in m/s
     Rover.vel = convert_to_float(data["speed"])
     # The current position of the rover
@@ -50,90 +97,53 @@ def update_rover(Rover, data):
     # The current steering angle
     Rover.steer = convert_to_float(data["steering_angle"])
     # Near sample flag
-    Rover.near_sample = np.int(data["near_sample"])
+    Rover.near_sample = int(data["near_sample"])
     # Picking up flag
-    Rover.picking_up = np.int(data["picking_up"])
+    Rover.picking_up = int(data["picking_up"])
     # Update number of rocks found
-    Rover.samples_found = Rover.samples_to_find - np.int(data["sample_count"])
-
-    print('speed =', Rover.vel, 'position =', Rover.pos, 'throttle =',
-          Rover.throttle, 'steer_angle =', Rover.steer, 'near_sample:', Rover.near_sample,
-          'picking_up:', data["picking_up"], 'sending pickup:', Rover.send_pickup,
-          'total time:', Rover.total_time, 'samples remaining:', data["sample_count"],
-          'samples found:', Rover.samples_found)
-    # Get the current image from the center camera of the rover
-    imgString = data["image"]
-    image = Image.open(BytesIO(base64.b64decode(imgString)))
-    Rover.img = np.asarray(image)
-
-    # Return updated Rover and separate image for optional saving
+    Rover.samples_found = Rover.samples_to_find - int(data["sample_count"])
+
+    # Print out the telemetry status every log_every frames
+    Rover.frame_count += 1
+    if Rover.log_every and Rover.frame_count % Rover.log_every == 0:
+        print('speed =', Rover.vel, 'position =', Rover.pos, 'throttle =',
+              Rover.throttle, 'steer_angle =', Rover.steer, 'near_sample:', Rover.near_sample,
+              'picking_up:', data["picking_up"], 'sending pickup:', Rover.send_pickup,
+              'total time:', Rover.total_time, 'samples remaining:', data["sample_count"],
+              'samples found:', Rover.samples_found)
+    # Get the current image from the center camera of the rover,
+    # decoded into the frame buffer of the previous image
+    if decoded is None:
+        decoded = decode_image(data["image"], Rover.img)
+    Rover.img, image = decoded
+
+    # Return updated Rover and the original JPEG bytes for optional saving
     return Rover, image
 
 # Define a function to create display output given worldmap results
 
 
-def create_output_images(Rover):
-
-    # Create a scaled map for plotting and clean up obs/nav pixels a bit
-    if np.max(Rover.worldmap[:, :, 2]) > 0:
-        nav_pix = Rover.worldmap[:, :, 2] > 0
-        navigable = Rover.worldmap[:, :, 2] * \
-            (255 / np.mean(Rover.worldmap[nav_pix, 2]))
-    else:
-        navigable = Rover.worldmap[:, :, 2]
-    if np.max(Rover.worldmap[:, :, 0]) > 0:
-        obs_pix = Rover.worldmap[:, :, 0] > 0
-        obstacle = Rover.worldmap[:, :, 0] * \
-            (255 / np.mean(Rover.worldmap[obs_pix, 0]))
-    else:
-        obstacle = Rover.worldmap[:, :, 0]
-
-    likely_nav = navigable >= obstacle
-    obstacle[likely_nav] = 0
-    plotmap = np.zeros_like(Rover.worldmap)
-    plotmap[:, :, 0] = obstacle
-    plotmap[:, :, 2] = navigable
-    plotmap = plotmap.clip(0, 255)
-    # Overlay obstacle and navigable terrain map with ground truth map
-    map_add = cv2.addWeighted(plotmap, 1, Rover.ground_truth, 0.5, 0)
-
-    # Check whether any rock detections are present in worldmap
-    rock_world_pos = Rover.worldmap[:, :, 1].nonzero()
-    # If there are, we'll step through the known sample positions
-    # to confirm whether detections are real
-    if rock_world_pos[0].any():
-        rock_size = 2
-        for idx in range(len(Rover.samples_pos[0])):
-            test_rock_x = Rover.samples_pos[0][idx]
-            test_rock_y = Rover.samples_pos[1][idx]
-            rock_sample_dists = np.sqrt((test_rock_x - rock_world_pos[1])**2 +
-                                        (test_rock_y - rock_world_pos[0])**2)
-            # If rocks were detected within 3 meters of known sample positions
-            # consider it a success and plot the location of the known
-            # sample on the map
-            if np.min(rock_sample_dists) < 3:
-                map_add[test_rock_y - rock_size:test_rock_y + rock_size,
-                        test_rock_x - rock_size:test_rock_x + rock_size, :] = 255
-
-    # Calculate some statistics on the map results
-    # First get the total number of pixels in the navigable terrain map
-    tot_nav_pix = np.float(len((plotmap[:, :, 2].nonzero()[0])))
-    # Next figure out how many of those correspond to ground truth pixels
-    good_nav_pix = np.float(
-        len(((plotmap[:, :, 2] > 0) & (Rover.ground_truth[:, :, 1] > 0)).nonzero()[0]))
-    # Next find how many do not correspond to ground truth pixels
-    bad_nav_pix = np.float(len(((plotmap[:, :, 2] > 0) & (
-        Rover.ground_truth[:, :, 1] == 0)).nonzero()[0]))
-    # Grab the total number of map pixels
-    tot_map_pix = np.float(len((Rover.ground_truth[:, :, 1].nonzero()[0])))
-    # Calculate the percentage of ground truth map that has been successfully found
-    perc_mapped = round(100 * good_nav_pix / tot_map_pix, 1)
-    # Calculate the number of good map pixel detections divided by total pixels
-    # found to be navigable terrain
-    if tot_nav_pix > 0:
-        fidelity = round(100 * good_nav_pix / (tot_nav_pix), 1)
-    else:
-        fidelity = 0
+def create_map_image(Rover):
+    """Overlay the worldmap on the ground truth map and
+    add text about map and rock sample detection results"""
+    # Obstacle and navigable terrain map overlaid on the ground truth map,
+    # kept up to date from each frame's hits by Rover.map_stats.
+    # A large tiled worldmap is only drawn in a window around the rover
+    map_add, (row, col) = Rover.map_stats.render(Rover.pos)
+
+    # Plot the known samples that rock detections within 3 meters
+    # have confirmed, Rover.rock_samples keeps them from frame to frame
+    rock_size = 2
+    for test_rock_x, test_rock_y in Rover.rock_samples.confirmed_positions(Rover.samples_pos,
+                                                                           Rover.worldmap):
+        test_rock_x, test_rock_y = test_rock_x - col, test_rock_y - row
+        if 0 <= test_rock_y < map_add.shape[0] and 0 <= test_rock_x < map_add.shape[1]:
+            map_add[test_rock_y - rock_size:test_rock_y + rock_size,
+                    test_rock_x - rock_size:test_rock_x + rock_size, :] = 255
+
+    # Statistics on the map results
+    perc_mapped = Rover.map_stats.perc_mapped
+    fidelity = Rover.map_stats.fidelity
     # Flip the map for plotting so that the y-axis points upward in the display
     map_add = np.flipud(map_add).astype(np.float32)
     # Add some text about map and rock sample detection results
@@ -145,6 +155,12 @@ def create_output_images(Rover):
                 cv2.FONT_HERSHEY_COMPLEX, 0.4, (255, 255, 255), 1)
     cv2.putText(map_add, "Rocks: " + str(Rover.samples_found), (0, 55),
                 cv2.FONT_HERSHEY_COMPLEX, 0.4, (255, 255, 255), 1)
+    return map_add
+
+
+def create_output_images(Rover):
+    """Create the map and vision inset images as base64 strings"""
+    map_add = create_map_image(Rover)
 
     # Convert map and vision image to base64 strings for sending to server
     pil_img = Image.fromarray(map_add.astype(np.uint8))
@@ -152,7 +168,7 @@ def create_output_images(Rover):
     pil_img.save(buff, format="JPEG")
     encoded_string1 = base64.b64encode(buff.getvalue()).decode("utf-8")
 
-    pil_img = Image.fromarray(Rover.vision_image.astype(np.uint8))
+    pil_img = Image.fromarray(Rover.vision_image)
     buff = BytesIO()
     pil_img.save(buff, format="JPEG")
     encoded_string2 = base64.b64encode(buff.getvalue()).decode("utf-8")
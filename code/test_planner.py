@@ -0,0 +1,101 @@
+import heapq
+import math
+
+import numpy as np
+
+from planner import GridPlanner, cell_costs, MOVES, NAVIGABLE_COST
+from worldmap import count_hits, add_hit_counts
+
+# Check the costs GridPlanner repairs against a Dijkstra search from scratch
+# Run: $ python -m pytest code/test_planner.py
+
+
+def make_worldmap(size=48, seed=0):
+    """Worldmap with navigable ground, obstacle walls and unmapped patches"""
+    rng = np.random.default_rng(seed)
+    worldmap = np.zeros((size, size, 3), dtype=np.uint16)
+    worldmap[:, :, 2] = 3
+    # Unmapped patches cost more than navigable ground
+    for _ in range(6):
+        row, col = rng.integers(0, size - 6, 2)
+        worldmap[row:row + 6, col:col + 6] = 0
+    # Walls with a gap, so paths have to go round them
+    worldmap[10, 4:size, 0] = 5
+    worldmap[10, 4:size, 2] = 0
+    worldmap[30, 0:size - 4, 0] = 5
+    worldmap[30, 0:size - 4, 2] = 0
+    return worldmap
+
+
+def reference_costs(worldmap, goal):
+    """Cost of the cheapest path from every cell to goal,
+    entering a cell costs its class cost times the move length"""
+    costs = cell_costs(worldmap[:, :, 2], worldmap[:, :, 0])
+    costs[goal] = NAVIGABLE_COST
+    rows, cols = costs.shape
+    dist = {goal: 0.0}
+    queue = [(0.0, goal)]
+    while queue:
+        cost, cell = heapq.heappop(queue)
+        if cost > dist[cell]:
+            continue
+        # Paths run backwards from the goal, into the cell just expanded
+        for dy, dx, length in MOVES:
+            neighbor = (cell[0] + dy, cell[1] + dx)
+            if 0 <= neighbor[0] < rows and 0 <= neighbor[1] < cols:
+                new_cost = cost + length * costs[cell]
+                if new_cost < dist.get(neighbor, math.inf):
+                    dist[neighbor] = new_cost
+                    heapq.heappush(queue, (new_cost, neighbor))
+    return dist
+
+
+def plan_to_end(planner, pos):
+    """Plan until the search is done, as decision_step does frame by frame"""
+    for _ in range(1000):
+        waypoints = planner.plan(pos, max_expansions=50)
+        if waypoints is not None:
+            return waypoints
+    raise AssertionError('No path was found')
+
+
+def path_cost(planner, pos):
+    return planner.rhs[planner.costs.cell(pos)]
+
+
+def test_plan_matches_dijkstra():
+    worldmap = make_worldmap()
+    goal = (40.5, 44.5)
+    planner = GridPlanner(worldmap, goal)
+    reference = reference_costs(worldmap, (44, 40))
+    # The rover moves, the search is repaired from one start to the next
+    for pos in [(5.5, 2.5), (20.5, 5.5), (2.5, 20.5), (30.5, 35.5)]:
+        assert plan_to_end(planner, pos) is not None
+        start = planner.costs.cell(pos)
+        assert math.isclose(path_cost(planner, pos), reference[start])
+
+
+def test_plan_repairs_blocked_path():
+    worldmap = make_worldmap()
+    goal = (40.5, 44.5)
+    pos = (5.5, 2.5)
+    planner = GridPlanner(worldmap, goal)
+    waypoints = plan_to_end(planner, pos)
+    # Block the cells the path goes through with obstacle hits
+    blocked = [(int(y), int(x)) for x, y in waypoints[5:8]]
+    hits = np.array([(y * worldmap.shape[1] + x) * 3 for y, x in blocked] * 10)
+    worldmap[tuple(np.transpose(blocked)) + (2,)] = 0
+    touched, counts = count_hits(hits)
+    add_hit_counts(worldmap, touched, counts)
+    planner.update(touched)
+    waypoints = plan_to_end(planner, pos)
+    assert not set(blocked) & {(int(y), int(x)) for x, y in waypoints}
+    reference = reference_costs(worldmap, (44, 40))
+    assert math.isclose(path_cost(planner, pos), reference[planner.costs.cell(pos)])
+
+
+def test_plan_spreads_search_over_calls():
+    planner = GridPlanner(make_worldmap(), (40.5, 44.5))
+    # A search needing more than max_expansions returns no path yet
+    assert planner.plan((5.5, 2.5), max_expansions=10) is None
+    assert plan_to_end(planner, (5.5, 2.5)) is not None
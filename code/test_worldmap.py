@@ -0,0 +1,74 @@
+import os
+
+import numpy as np
+
+from drive_rover import RoverState
+from perception import perception_step
+from replay import read_robot_log, frame_jpeg
+from supporting_functions import decode_jpeg
+from worldmap import (MapStats, TiledMapStats, TiledWorldmap, count_hits, add_hit_counts,
+                      cell_values)
+
+# Check the incremental map statistics and the tiled worldmap against
+# full recomputes and the dense worldmap, on frames of the test dataset
+# Run: $ python -m pytest code/test_worldmap.py
+
+ROBOT_LOG = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         '..', 'test_dataset', 'robot_log.csv')
+STATS = ['tot_nav_pix', 'good_nav_pix', 'obs_pix', 'nav_sum', 'obs_sum',
+         'perc_mapped', 'fidelity']
+
+
+def replay_frames(Rover, frames):
+    """Run frames through perception_step, yield Rover after each one"""
+    for frame in frames:
+        Rover.img = decode_jpeg(frame_jpeg(frame), Rover.img)
+        Rover.pos = frame['pos']
+        Rover.yaw = frame['yaw']
+        Rover.pitch = frame['pitch']
+        Rover.roll = frame['roll']
+        yield perception_step(Rover)
+
+
+def stats(map_stats):
+    return [getattr(map_stats, name) for name in STATS]
+
+
+def test_count_hits_counts_duplicates():
+    # Hits on the same entry within one frame all count
+    touched, counts = count_hits(np.array([7, 3, 7, 7, 11, 3]))
+    assert touched.tolist() == [3, 7, 11]
+    assert counts.tolist() == [2, 3, 1]
+    worldmap = np.zeros((2, 2, 3), dtype=np.uint16)
+    add_hit_counts(worldmap, touched, counts)
+    assert worldmap.reshape(-1)[[3, 7, 11]].tolist() == [2, 3, 1]
+    assert worldmap.sum() == 6
+
+
+def test_add_hit_counts_saturates():
+    worldmap = np.full((2, 2, 3), 65530, dtype=np.uint16)
+    add_hit_counts(worldmap, *count_hits(np.array([0] * 10 + [1])))
+    assert worldmap.reshape(-1)[:3].tolist() == [65535, 65531, 65530]
+
+
+def test_map_stats_match_recompute():
+    Rover = RoverState()
+    for Rover in replay_frames(Rover, read_robot_log(ROBOT_LOG)[:40]):
+        recomputed = MapStats(Rover.worldmap, Rover.ground_truth)
+        assert stats(Rover.map_stats) == stats(recomputed)
+    assert Rover.map_stats.tot_nav_pix > 0
+
+
+def test_tiled_worldmap_matches_dense():
+    frames = read_robot_log(ROBOT_LOG)[:40]
+    dense = RoverState()
+    tiled = RoverState()
+    tiled.worldmap = TiledWorldmap(dense.worldmap.shape[0], tile_size=64)
+    tiled.map_stats = TiledMapStats(tiled.worldmap, tiled.ground_truth)
+    for dense, tiled in zip(replay_frames(dense, frames), replay_frames(tiled, frames)):
+        assert stats(tiled.map_stats) == stats(dense.map_stats)
+    flat = np.arange(dense.worldmap.size)
+    assert (cell_values(tiled.worldmap, flat) == dense.worldmap.reshape(-1)).all()
+    image, origin = tiled.map_stats.render(dense.pos)
+    assert origin == (0, 0)
+    assert np.allclose(image, dense.map_stats.render()[0])
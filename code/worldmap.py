@@ -0,0 +1,439 @@
+import os
+
+import numpy as np
+import cv2
+
+# Worldmap accumulation.
+# The worldmap is a (rows, cols, layers) uint16 array of hit counts with
+# layer 0 for obstacles, 1 for rock samples and 2 for navigable terrain.
+# Counts saturate at 65535 instead of wrapping around.
+# World coords of one frame are flattened into indices of the worldmap
+# so that all layers are updated with one counting pass.
+# A TiledWorldmap can stand in for the array: it takes the same flat
+# indices but only allocates the tiles the rover has observed.
+
+
+def world_hits(worldmap_shape, layers):
+    """Flatten world coords into worldmap indices.
+    Input: worldmap shape, sequence of (x_world, y_world) per layer
+    Output: flat indices into the worldmap, one per hit.
+    Coords outside the worldmap are dropped."""
+    rows, cols, depth = worldmap_shape
+    hits = []
+    for layer, (x_world, y_world) in enumerate(layers):
+        inside = (x_world >= 0) & (x_world < cols) & (y_world >= 0) & (y_world < rows)
+        if not inside.all():
+            x_world, y_world = x_world[inside], y_world[inside]
+        hits.append((np.intp(y_world) * cols + x_world) * depth + layer)
+    return np.concatenate(hits)
+
+
+def count_hits(hits):
+    """Count the hits on each worldmap entry.
+    Duplicate hits on the same cell are all counted, unlike
+    worldmap[y, x, c] += 1 with fancy indexing.
+    Output: flat indices of the touched worldmap entries, hits on each"""
+    if len(hits) == 0:
+        return np.array([], dtype=np.intp), np.array([], dtype=np.intp)
+    # Count over the span of this frame's hits only, not the whole map
+    low = hits.min()
+    counts = np.bincount(hits - low)
+    touched = np.flatnonzero(counts)
+    counts = counts[touched]
+    touched += low
+    return touched, counts
+
+
+def add_hit_counts(worldmap, touched, counts):
+    """Add the counts of count_hits to a worldmap or TiledWorldmap"""
+    if isinstance(worldmap, TiledWorldmap):
+        worldmap.add(touched, counts)
+    else:
+        add_counts(worldmap.reshape(-1), touched, counts)
+
+
+def add_counts(flat_map, flat, counts):
+    """flat_map[flat] += counts for unique flat indices,
+    saturating at the largest count the dtype holds"""
+    flat_map[flat] = np.minimum(flat_map[flat] + counts, np.iinfo(flat_map.dtype).max)
+
+
+def cell_values(worldmap, flat):
+    """Worldmap entries at flat indices"""
+    if isinstance(worldmap, TiledWorldmap):
+        return worldmap.values(flat)
+    return worldmap.reshape(-1)[flat]
+
+
+def worldmap_blocks(worldmap):
+    """Allocated parts of a worldmap as (row, col, block) with
+    row, col the worldmap position of the block's first cell.
+    Blocks are views, writes to them update the worldmap."""
+    if isinstance(worldmap, TiledWorldmap):
+        return worldmap.blocks()
+    return [(0, 0, worldmap)]
+
+
+def clean_obstacles(worldmap):
+    """Clear the obstacle counts of cells also mapped as navigable.
+    Output: number of cells cleared"""
+    cleared = 0
+    for _, _, block in worldmap_blocks(worldmap):
+        crossed = (block[:, :, 2] > 0) & (block[:, :, 0] > 0)
+        count = np.count_nonzero(crossed)
+        if count:
+            block[:, :, 0][crossed] = 0
+            cleared += count
+    return cleared
+
+
+class RockSamples():
+    """Known rock sample positions confirmed by rock detections.
+    A sample is confirmed once a rock cell of the worldmap lies closer
+    than radius cells to it. The cells near every sample are indexed,
+    so each frame only looks up its new rock cells, and confirmed
+    samples are kept instead of being checked again."""
+
+    def __init__(self, radius=3):
+        self.radius = radius
+        self.positions = None  # (x, y) arrays of the indexed samples
+        self.near = {}  # flat worldmap cell: samples closer than radius
+        self.confirmed = set()  # Indices of the confirmed samples
+
+    def index(self, samples_pos, worldmap):
+        """Index sample positions, confirming them from the rock cells mapped so far"""
+        self.positions = samples_pos
+        self.near = {}
+        self.confirmed = set()
+        rows, cols, depth = worldmap.shape
+        offsets = [(dy, dx) for dy in range(-self.radius, self.radius + 1)
+                   for dx in range(-self.radius, self.radius + 1)
+                   if dy**2 + dx**2 < self.radius**2]
+        for idx, (x, y) in enumerate(zip(*samples_pos)):
+            cells = [(y + dy) * cols + x + dx for dy, dx in offsets
+                     if 0 <= y + dy < rows and 0 <= x + dx < cols]
+            for cell in cells:
+                self.near.setdefault(cell, []).append(idx)
+            if cells and cell_values(worldmap, np.intp(cells) * depth + 1).any():
+                self.confirmed.add(idx)
+
+    def update(self, worldmap, touched):
+        """Confirm samples near the rock entries touched by a frame in map_frame"""
+        if not self.near or len(self.confirmed) == len(self.positions[0]):
+            return
+        depth = worldmap.shape[2]
+        for cell in (touched[touched % depth == 1] // depth).tolist():
+            self.confirmed.update(self.near.get(cell, ()))
+
+    def confirmed_positions(self, samples_pos, worldmap):
+        """(x, y) of the confirmed samples of samples_pos"""
+        if samples_pos is not self.positions:
+            self.index(samples_pos, worldmap)
+        return [(samples_pos[0][idx], samples_pos[1][idx]) for idx in sorted(self.confirmed)]
+
+
+class TiledWorldmap():
+    """Sparse worldmap of world_size x world_size cells.
+    Cells are stored in square tiles of tile_size cells that are only
+    allocated when something is mapped on them, so memory follows the
+    explored area instead of the square of world_size. Flat indices
+    are those of the dense (world_size, world_size, depth) array."""
+
+    def __init__(self, world_size, tile_size=64, depth=3, dtype=np.uint16):
+        self.shape = (world_size, world_size, depth)
+        self.tile_size = tile_size
+        self.dtype = dtype
+        self.tiles_per_row = -(-world_size // tile_size)
+        self.tiles = {}  # tile key: (tile_size, tile_size, depth) array
+
+    def tile_origin(self, key):
+        """Worldmap (row, col) of the first cell of a tile"""
+        tile_row, tile_col = divmod(key, self.tiles_per_row)
+        return tile_row * self.tile_size, tile_col * self.tile_size
+
+    def split(self, flat):
+        """Tile keys and flat indices inside the tiles of worldmap flat indices"""
+        depth = self.shape[2]
+        cells, layer = np.divmod(flat, depth)
+        ypos, xpos = np.divmod(cells, self.shape[1])
+        tile_row, tile_y = np.divmod(ypos, self.tile_size)
+        tile_col, tile_x = np.divmod(xpos, self.tile_size)
+        keys = tile_row * self.tiles_per_row + tile_col
+        return keys, (tile_y * self.tile_size + tile_x) * depth + layer
+
+    def groups(self, flat):
+        """Yield (tile key, selection, in-tile indices) per tile of flat indices"""
+        keys, inner = self.split(flat)
+        for key in np.unique(keys):
+            selected = keys == key
+            yield int(key), selected, inner[selected]
+
+    def add(self, flat, counts):
+        """Add counts at unique flat indices, allocating tiles as needed"""
+        for key, selected, inner in self.groups(flat):
+            tile = self.tiles.get(key)
+            if tile is None:
+                tile = self.tiles[key] = np.zeros(
+                    (self.tile_size, self.tile_size, self.shape[2]), dtype=self.dtype)
+            add_counts(tile.reshape(-1), inner, counts[selected])
+
+    def values(self, flat):
+        """Entries at flat indices, 0 on tiles not allocated"""
+        values = np.zeros(len(flat), dtype=self.dtype)
+        for key, selected, inner in self.groups(flat):
+            tile = self.tiles.get(key)
+            if tile is not None:
+                values[selected] = tile.reshape(-1)[inner]
+        return values
+
+    def blocks(self):
+        return [self.tile_origin(key) + (tile,) for key, tile in self.tiles.items()]
+
+    @property
+    def nbytes(self):
+        return sum(tile.nbytes for tile in self.tiles.values())
+
+
+def open_worldmap(path, shape, dtype=np.uint16):
+    """Open a worldmap kept in a memory-mapped .npy file.
+    An existing file is resumed, otherwise an empty one is created.
+    Other processes can read the file with np.load(path, mmap_mode='r')
+    while it is being mapped."""
+    if os.path.exists(path):
+        worldmap = np.lib.format.open_memmap(path, mode='r+')
+        if worldmap.shape != tuple(shape) or worldmap.dtype != dtype:
+            raise ValueError('Worldmap file {} holds a {} {} array, expected {} {}'.format(
+                path, worldmap.shape, worldmap.dtype, tuple(shape), np.dtype(dtype)))
+        return worldmap
+    return np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=tuple(shape))
+
+
+def load_ground_truth(png_path, cache_path=None):
+    """Load the ground truth map as a binary map and a 3-channel version
+    with the map in the green channel, for overplotting.
+    Both are cached in an .npz file next to the PNG by default, which
+    is made again whenever the PNG's modification time or size changes.
+    Output: binary map, green map"""
+    if cache_path is None:
+        cache_path = os.path.splitext(png_path)[0] + '.npz'
+    stat = os.stat(png_path)
+    key = np.array([stat.st_mtime_ns, stat.st_size], dtype=np.int64)
+    try:
+        with np.load(cache_path) as cache:
+            if np.array_equal(cache['key'], key):
+                return cache['truth'], cache['green']
+    except (OSError, KeyError, ValueError):
+        pass
+    gray = cv2.imread(png_path, cv2.IMREAD_GRAYSCALE)
+    if gray is None:
+        raise OSError('Could not read the ground truth map {}'.format(png_path))
+    truth = gray > 0
+    green = np.zeros(gray.shape + (3,), dtype=np.uint8)
+    green[:, :, 1] = gray
+    # Written under another name first, so a process starting at
+    # the same time never reads half a cache
+    partial = '{}.{}.tmp'.format(cache_path, os.getpid())
+    try:
+        with open(partial, 'wb') as f:
+            np.savez(f, key=key, truth=truth, green=green)
+        os.replace(partial, cache_path)
+    except OSError:
+        # A read-only checkout still starts, without the cache
+        if os.path.exists(partial):
+            os.remove(partial)
+    return truth, green
+
+
+class MapStats():
+    """Mapping statistics and the display overlay of the worldmap.
+    Both are updated from the worldmap entries each frame touches
+    instead of rescanning the whole map. The overlay keeps the
+    navigable/obstacle scale of its last full redraw until a layer
+    mean drifts by more than rescale_tolerance."""
+
+    def __init__(self, worldmap, ground_truth, rescale_tolerance=0.05):
+        self.ground_truth = ground_truth
+        self.truth = ground_truth[:, :, 1] > 0
+        # The ground truth as it is drawn under the worldmap
+        self.truth_overlay = np.multiply(ground_truth, 0.5, dtype=np.float32)
+        self.tot_map_pix = np.count_nonzero(self.truth)
+        self.rescale_tolerance = rescale_tolerance
+        self.reset(worldmap)
+
+    def reset(self, worldmap):
+        """Recompute the statistics and the overlay from the whole worldmap"""
+        self.tot_nav_pix = 0  # Navigable cells
+        self.good_nav_pix = 0  # Navigable cells on ground truth
+        self.nav_sum = 0.0  # Hits on navigable cells
+        self.obs_pix = 0  # Obstacle cells
+        self.obs_sum = 0.0  # Hits on obstacle cells
+        for row, col, block in worldmap_blocks(worldmap):
+            ypos, xpos = (block[:, :, 2] > 0).nonzero()
+            self.tot_nav_pix += len(ypos)
+            self.good_nav_pix += np.count_nonzero(self._on_truth(ypos + row, xpos + col))
+            self.nav_sum += float(block[:, :, 2].sum())
+            self.obs_pix += np.count_nonzero(block[:, :, 0])
+            self.obs_sum += float(block[:, :, 0].sum())
+        self._redraw(worldmap)
+
+    @property
+    def bad_nav_pix(self):
+        return self.tot_nav_pix - self.good_nav_pix
+
+    @property
+    def perc_mapped(self):
+        """Percentage of ground truth map that has been successfully found"""
+        return round(100 * self.good_nav_pix / self.tot_map_pix, 1)
+
+    @property
+    def fidelity(self):
+        """Good map pixel detections divided by total pixels found to be navigable"""
+        if self.tot_nav_pix > 0:
+            return round(100 * self.good_nav_pix / self.tot_nav_pix, 1)
+        return 0
+
+    def _on_truth(self, ypos, xpos):
+        """Whether worldmap cells are navigable on the ground truth,
+        cells beyond the ground truth map are not"""
+        rows, cols = self.truth.shape
+        inside = (ypos < rows) & (xpos < cols)
+        if inside.all():
+            return self.truth[ypos, xpos]
+        on_truth = np.zeros(len(ypos), dtype=bool)
+        on_truth[inside] = self.truth[ypos[inside], xpos[inside]]
+        return on_truth
+
+    def _means(self):
+        nav_mean = self.nav_sum / self.tot_nav_pix if self.tot_nav_pix else 0
+        obs_mean = self.obs_sum / self.obs_pix if self.obs_pix else 0
+        return nav_mean, obs_mean
+
+    def _drifted(self):
+        for mean, drawn_mean in zip(self._means(), (self.nav_mean, self.obs_mean)):
+            if drawn_mean == 0:
+                if mean != 0:
+                    return True
+            elif abs(mean / drawn_mean - 1) > self.rescale_tolerance:
+                return True
+        return False
+
+    def _redraw(self, worldmap):
+        """Scale both layers by their mean and overlay the ground truth"""
+        self.nav_mean, self.obs_mean = self._means()
+        plotmap = np.zeros(worldmap.shape, dtype=np.float32)
+        plotmap[:, :, 0], plotmap[:, :, 2] = self._draw_layers(worldmap[:, :, 2],
+                                                               worldmap[:, :, 0])
+        self.overlay = cv2.add(plotmap, self.truth_overlay)
+
+    def _draw_cells(self, worldmap, ypos, xpos):
+        """Redraw the overlay at some cells with the current scale"""
+        obstacle, navigable = self._draw_layers(worldmap[ypos, xpos, 2],
+                                                worldmap[ypos, xpos, 0])
+        self.overlay[ypos, xpos, 0] = obstacle + self.truth_overlay[ypos, xpos, 0]
+        self.overlay[ypos, xpos, 2] = navigable + self.truth_overlay[ypos, xpos, 2]
+
+    def _draw_layers(self, nav_counts, obs_counts):
+        """Scaled obstacle and navigable values, with obstacles
+        cleaned up where navigable terrain is more likely"""
+        navigable = np.multiply(nav_counts, 255 / self.nav_mean if self.nav_mean else 1,
+                                dtype=np.float32)
+        obstacle = np.multiply(obs_counts, 255 / self.obs_mean if self.obs_mean else 1,
+                               dtype=np.float32)
+        obstacle = np.where(navigable >= obstacle, 0, obstacle)
+        return obstacle.clip(0, 255), navigable.clip(0, 255)
+
+    def render(self, center=None):
+        """Overlay image of the worldmap on the ground truth.
+        center is the rover position (x, y), the whole map is drawn here.
+        Output: image, worldmap (row, col) of its first cell"""
+        return self.overlay.copy(), (0, 0)
+
+    def update(self, worldmap, touched, counts):
+        """Update with the worldmap entries touched by a frame in map_frame"""
+        if len(touched) == 0:
+            return
+        depth = worldmap.shape[2]
+        layer = touched % depth
+        cells = touched // depth
+        # Entries holding exactly what was just added were empty before
+        new = cell_values(worldmap, touched) == counts
+        nav = layer == 2
+        obs = layer == 0
+        new_y, new_x = np.divmod(cells[nav & new], worldmap.shape[1])
+        self.tot_nav_pix += len(new_y)
+        self.good_nav_pix += np.count_nonzero(self._on_truth(new_y, new_x))
+        self.nav_sum += float(counts[nav].sum())
+        self.obs_pix += np.count_nonzero(obs & new)
+        self.obs_sum += float(counts[obs].sum())
+        if self._drifted():
+            self._redraw(worldmap)
+        else:
+            ypos, xpos = np.divmod(np.unique(cells[nav | obs]), worldmap.shape[1])
+            self._draw_cells(worldmap, ypos, xpos)
+
+
+class TiledMapStats(MapStats):
+    """MapStats of a TiledWorldmap. The overlay is drawn per
+    allocated tile, so it also grows with the explored area, and
+    render only puts together the tiles inside a window of the
+    worldmap. The window is the size of the ground truth map."""
+
+    def __init__(self, worldmap, ground_truth, rescale_tolerance=0.05):
+        self.worldmap = worldmap
+        super().__init__(worldmap, ground_truth, rescale_tolerance)
+
+    def _redraw(self, worldmap):
+        self.nav_mean, self.obs_mean = self._means()
+        self.drawn = {}  # tile key: overlay of the tile without the ground truth
+        for key, tile in worldmap.tiles.items():
+            drawn = self.drawn[key] = np.zeros(tile.shape, dtype=np.float32)
+            drawn[:, :, 0], drawn[:, :, 2] = self._draw_layers(tile[:, :, 2], tile[:, :, 0])
+
+    def _draw_cells(self, worldmap, ypos, xpos):
+        depth = worldmap.shape[2]
+        for key, _, inner in worldmap.groups((ypos * worldmap.shape[1] + xpos) * depth):
+            tile = worldmap.tiles[key]
+            drawn = self.drawn.get(key)
+            if drawn is None:
+                drawn = self.drawn[key] = np.zeros(tile.shape, dtype=np.float32)
+            tile_y, tile_x = np.divmod(inner // depth, worldmap.tile_size)
+            drawn[tile_y, tile_x, 0], drawn[tile_y, tile_x, 2] = self._draw_layers(
+                tile[tile_y, tile_x, 2], tile[tile_y, tile_x, 0])
+
+    def window_origin(self, center):
+        """First cell of the window shown for a rover at center (x, y).
+        The window stays on the ground truth map while the rover is on it,
+        and follows the rover beyond it."""
+        rows, cols = self.truth.shape
+        if center is None:
+            return 0, 0
+        xpos, ypos = int(center[0]), int(center[1])
+        if 0 <= ypos < rows and 0 <= xpos < cols:
+            return 0, 0
+        world_rows, world_cols = self.worldmap.shape[:2]
+        row = min(max(ypos - rows // 2, 0), max(world_rows - rows, 0))
+        col = min(max(xpos - cols // 2, 0), max(world_cols - cols, 0))
+        return row, col
+
+    def render(self, center=None):
+        """Overlay image of the window around center, put together from
+        the ground truth and the tiles that overlap the window only"""
+        rows, cols = self.truth.shape
+        row, col = self.window_origin(center)
+        image = np.zeros((rows, cols, 3), dtype=np.float32)
+        # Ground truth inside the window
+        image[:max(rows - row, 0), :max(cols - col, 0)] = self.truth_overlay[row:, col:]
+        tile_size, per_row = self.worldmap.tile_size, self.worldmap.tiles_per_row
+        for tile_row in range(row // tile_size, min(-(-(row + rows) // tile_size), per_row)):
+            for tile_col in range(col // tile_size, min(-(-(col + cols) // tile_size), per_row)):
+                drawn = self.drawn.get(tile_row * per_row + tile_col)
+                if drawn is None:
+                    continue
+                # Overlap of the tile and the window, in worldmap cells
+                top, left = max(tile_row * tile_size, row), max(tile_col * tile_size, col)
+                bottom = min((tile_row + 1) * tile_size, row + rows)
+                right = min((tile_col + 1) * tile_size, col + cols)
+                image[top - row:bottom - row, left - col:right - col] += drawn[
+                    top - tile_row * tile_size:bottom - tile_row * tile_size,
+                    left - tile_col * tile_size:right - tile_col * tile_size]
+        return image, (row, col)